@@ -0,0 +1,283 @@
+# benchmark.py
+# ----------------------
+# 性能基准（不依赖 PyQt5）
+# 在临时目录中生成合成图片（不同像素数、RGB/RGBA/P/L 模式、JPEG/PNG 格式），
+# 分别计时字体加载、解码、渲染、编码、单张完整处理以及多进程批量导出，
+# 输出每张/秒、p50/p99 延迟与峰值内存（RSS）的 JSON，便于在不同提交、Pillow 版本之间对比。
+# 安装了 NumPy 时另外比较 Pillow 与 numpy_compositor 在不同字号下的包围盒混合耗时。
+# 用法：python main.py bench --megapixels 1 12 --json result.json
+# ----------------------
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from dataclasses import replace
+
+from PIL import Image
+
+import numpy_compositor
+from export_pool import default_worker_count, make_job, run_export
+from watermark_engine import (WatermarkSettings, find_system_font_path, load_font, clear_tile_cache,
+                              get_text_tile, _clip_tile, open_image, render, save_image, render_file, output_path_for)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_MEGAPIXELS = [1, 12]
+DEFAULT_MODES = ["RGB", "RGBA", "P", "L"]
+DEFAULT_FORMATS = ["JPEG", "PNG"]
+DEFAULT_REPEAT = 5
+FONT_REPEAT = 20
+COMPOSITOR_FONT_SIZES = [32, 64, 200, 600]
+# JPEG 不能保存透明通道与调色板，这些组合会被跳过
+JPEG_MODES = ("RGB", "L")
+
+
+def make_synthetic_image(megapixels, mode):
+    """生成 3:2 的合成图片：渐变加低频噪声，压缩难度接近照片，而不是纯色或纯噪声"""
+    width = int((megapixels * 1_000_000 * 3 / 2) ** 0.5)
+    height = int(width * 2 / 3)
+    gradient = Image.linear_gradient("L").resize((width, height), Image.BILINEAR)
+    noise = Image.effect_noise((max(1, width // 8), max(1, height // 8)), 64).resize((width, height), Image.BILINEAR)
+    radial = Image.radial_gradient("L").resize((width, height), Image.BILINEAR)
+    img = Image.merge("RGB", (gradient, noise, radial))
+    if mode == "RGBA":
+        img.putalpha(Image.linear_gradient("L").rotate(90).resize((width, height), Image.BILINEAR))
+    elif mode == "P":
+        img = img.quantize(256)
+    elif mode == "L":
+        img = img.convert("L")
+    return img
+
+
+def generate_inputs(folder, megapixels_list, modes, formats):
+    """返回 [(用例名, 文件路径)]"""
+    cases = []
+    for megapixels in megapixels_list:
+        for mode in modes:
+            img = None
+            for fmt in formats:
+                if fmt == "JPEG" and mode not in JPEG_MODES:
+                    continue
+                if img is None:
+                    img = make_synthetic_image(megapixels, mode)
+                name = f"{megapixels:g}mp_{mode}_{fmt.lower()}"
+                path = os.path.join(folder, name + (".jpg" if fmt == "JPEG" else ".png"))
+                img.save(path, format=fmt)
+                cases.append((name, path))
+    return cases
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize(samples):
+    """秒为单位的样本 -> 毫秒统计"""
+    total = sum(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(total / len(samples) * 1000, 3) if samples else None,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3) if samples else None,
+        "p99_ms": round(percentile(samples, 99) * 1000, 3) if samples else None,
+        "per_second": round(len(samples) / total, 3) if total > 0 else None,
+    }
+
+
+def time_call(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def peak_rss_mb(who="self"):
+    """进程的历史峰值 RSS（MB）；平台不支持时返回 None"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # Linux 上单位是 KB，macOS 上是字节
+    scale = 1 if sys.platform == "darwin" else 1024
+    return round(usage.ru_maxrss * scale / (1024 * 1024), 1)
+
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def bench_font(settings, repeat=FONT_REPEAT):
+    def cold():
+        load_font.cache_clear()
+        load_font(settings.font_path, settings.font_size)
+
+    cold_samples = time_call(cold, repeat)
+    warm_samples = time_call(lambda: load_font(settings.font_path, settings.font_size), repeat)
+    return {"cold": summarize(cold_samples), "warm": summarize(warm_samples)}
+
+
+def bench_case(path, settings, out_folder, repeat):
+    decode = time_call(lambda: open_image(path).close(), repeat)
+
+    img = open_image(path)
+    clear_tile_cache()
+    start = time.perf_counter()
+    rendered = render(img, settings)
+    render_cold = time.perf_counter() - start
+    render_warm = time_call(lambda: render(img, settings), repeat)
+
+    output_path = output_path_for(path, settings, out_folder)
+    encode = time_call(lambda: save_image(rendered, output_path, settings), repeat)
+    output_bytes = os.path.getsize(output_path)
+    rendered.close()
+    img.close()
+
+    full = time_call(lambda: render_file(path, settings, out_folder), repeat)
+    return {
+        "input_bytes": os.path.getsize(path),
+        "output_bytes": output_bytes,
+        "decode": summarize(decode),
+        "render_cold_ms": round(render_cold * 1000, 3),
+        "render": summarize(render_warm),
+        "encode": summarize(encode),
+        "full": summarize(full),
+    }
+
+
+def bench_compositor(settings, repeat, megapixels=12):
+    """同一 RGB 底图上分别用 Pillow 与 numpy_compositor 混合水印块（只计混合本身）"""
+    if not numpy_compositor.available():
+        return None
+    base = make_synthetic_image(megapixels, "RGB")
+    results = {}
+    for font_size in COMPOSITOR_FONT_SIZES:
+        tile, _, _ = get_text_tile(replace(settings, font_size=font_size))
+        # 与 render 相同：裁掉超出底图的部分
+        dest, source = _clip_tile(base.size, tile.size, (base.width // 8, base.height // 8))
+        region = tile.crop(source)
+        pillow = time_call(lambda: base.paste(region, dest, mask=region), repeat)
+        numpy_compositor.composite(base, tile, dest, source)  # 预热：预乘结果只在第一次计算
+        numpy_single = time_call(lambda: numpy_compositor.composite(base, tile, dest, source), repeat)
+        results[str(font_size)] = {
+            "tile_size": list(tile.size),
+            "pillow": summarize(pillow),
+            "numpy": summarize(numpy_single),
+        }
+    return results
+
+
+def bench_batch(paths, settings, out_folder, workers, engine, queue_size=None):
+    """多进程批量导出：每张延迟为相邻两次完成之间的间隔，反映实际吞吐"""
+    jobs = [make_job(path, settings, out_folder) for path in paths]
+    completions = []
+    start = time.perf_counter()
+    success, errors = run_export(jobs, workers=workers, engine=engine, queue_size=queue_size,
+                                 on_result=lambda result: completions.append(time.perf_counter()))
+    elapsed = time.perf_counter() - start
+    gaps = [b - a for a, b in zip([start] + completions[:-1], completions)]
+    stats = summarize(gaps)
+    stats.update({
+        "images": len(jobs),
+        "success": success,
+        "errors": errors,
+        "workers": workers,
+        "engine": engine,
+        "elapsed_s": round(elapsed, 3),
+        "images_per_second": round(len(jobs) / elapsed, 3) if elapsed > 0 else None,
+    })
+    return stats
+
+
+def run_benchmark(megapixels_list=None, modes=None, formats=None, repeat=None,
+                  output_format="JPEG", workers=None, batch_size=None, engine="process",
+                  queue_size=None, font_path=None, log=None):
+    """
+    执行全部基准，返回可 JSON 序列化的结果 dict；log(msg) 用于输出进度。
+    参数为 None 时使用默认值；modes / formats 含不支持的取值时抛出 ValueError。
+    """
+    megapixels_list = megapixels_list or DEFAULT_MEGAPIXELS
+    modes = modes or DEFAULT_MODES
+    formats = formats or DEFAULT_FORMATS
+    repeat = repeat or DEFAULT_REPEAT
+    for values, supported, label in ((modes, DEFAULT_MODES, "模式"), (formats, DEFAULT_FORMATS, "格式")):
+        unknown = [v for v in values if v not in supported]
+        if unknown:
+            raise ValueError(f"不支持的{label}: {' '.join(unknown)}（可选 {' '.join(supported)}）")
+    workers = workers or default_worker_count()
+    log = log or (lambda msg: None)
+    settings = WatermarkSettings(text="© Benchmark Watermark", font_size=64, opacity=60,
+                                 color=(255, 255, 255), output_format=output_format,
+                                 font_path=font_path or find_system_font_path())
+
+    tmp = tempfile.mkdtemp(prefix="pw_bench_")
+    try:
+        in_folder = os.path.join(tmp, "in")
+        out_folder = os.path.join(tmp, "out")
+        os.makedirs(in_folder)
+        os.makedirs(out_folder)
+        log("生成合成图片...")
+        cases = generate_inputs(in_folder, megapixels_list, modes, formats)
+
+        log("字体加载...")
+        font = bench_font(settings)
+        results = {}
+        for name, path in cases:
+            log(f"用例 {name}...")
+            results[name] = bench_case(path, settings, out_folder, repeat)
+
+        # 批量导出使用第一个（最小的）像素数的全部用例，重复到 batch_size 张
+        small = [path for name, path in cases if name.startswith(f"{megapixels_list[0]:g}mp_")]
+        batch_size = batch_size or max(len(small), workers * 4)
+        batch_paths = [small[i % len(small)] for i in range(batch_size)]
+        log(f"批量导出 {batch_size} 张（{workers} 进程）...")
+        batch = bench_batch(batch_paths, settings, out_folder, workers, engine, queue_size)
+        log("混合实现对比...")
+        compositor = bench_compositor(settings, repeat, megapixels_list[-1])
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "pillow": Image.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+            "output_format": output_format,
+            "font_path": settings.font_path,
+        },
+        "font": font,
+        "cases": results,
+        "batch": batch,
+        "compositor": compositor,
+        "peak_rss_mb": {"self": peak_rss_mb("self"), "children": peak_rss_mb("children")},
+    }
+
+
+def write_report(report, path=None):
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
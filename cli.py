@@ -0,0 +1,297 @@
+# cli.py
+# ----------------------
+# 命令行批处理模式（无界面）
+# 用法：python main.py batch --template foo --input DIR --output DIR --jobs N
+#       python main.py watch --template foo --input DIR --output DIR
+# 本模块及其依赖都不导入 PyQt5，可在无显示的服务器、cron 或 CI 中运行。
+# ----------------------
+import os
+import sys
+import signal
+import argparse
+import threading
+from functools import partial
+
+import profiling
+import watch_folder
+from export_pool import ENGINES, default_worker_count, make_job, run_export, ExportProgress
+from export_manifest import run_incremental_export, resume_export
+from file_scanner import scan_image_list, parse_patterns, relative_subfolder
+from template_store import load_template
+from watermark_engine import (WatermarkSettings, OUTPUT_FORMATS, DEFAULT_MAX_MEMORY_MB, COMPOSITORS,
+                              IMAGE_WATERMARK, find_system_font_path, set_compositor)
+
+
+def collect_input_files(inputs, recursive=False, include=None, exclude=None):
+    """
+    展开输入参数，返回 [(图片路径, 输出子目录)]：目录取其中的图片文件（recursive 时包括子目录），
+    子目录中的图片输出到对应的子目录；文件直接使用，输出到输出文件夹根目录。
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files.extend((path, relative_subfolder(path, item))
+                         for path in scan_image_list(item, recursive=recursive, include=include, exclude=exclude))
+        elif os.path.isfile(item):
+            files.append((item, ""))
+        else:
+            print(f"跳过不存在的输入: {item}", file=sys.stderr)
+    return files
+
+
+def settings_from_template(name_or_path):
+    """读取模板，返回 (模板 dict, WatermarkSettings)；模板未指定字体时使用系统字体"""
+    tpl = load_template(name_or_path)
+    settings = WatermarkSettings.from_template(tpl)
+    if not settings.font_path:
+        settings = WatermarkSettings.from_template(tpl, font_path=find_system_font_path())
+    return tpl, settings
+
+
+def cmd_batch(args):
+    try:
+        tpl, settings = settings_from_template(args.template)
+    except Exception as e:
+        print(f"加载模板失败: {e}", file=sys.stderr)
+        return 2
+
+    output_folder = args.output or tpl.get("output_folder", "")
+    if not output_folder:
+        print("请通过 --output 指定输出文件夹", file=sys.stderr)
+        return 2
+
+    files = collect_input_files(args.input, args.recursive, parse_patterns(args.include),
+                                parse_patterns(args.exclude))
+    if not files:
+        print("没有找到可处理的图片", file=sys.stderr)
+        return 1
+
+    # 递归扫描时，位于输出文件夹内的文件（之前的导出结果）不作为输入
+    output_abs = os.path.abspath(output_folder)
+    files = [(f, subfolder) for f, subfolder in files if not os.path.abspath(f).startswith(output_abs + os.sep)]
+    jobs = [make_job(image_path, settings, output_folder, subfolder) for image_path, subfolder in files]
+
+    # 与 GUI 相同的安全检查：不能导出到原图片所在文件夹
+    for job in jobs:
+        if os.path.abspath(job["output_folder"]) == os.path.abspath(os.path.dirname(job["image_path"])):
+            print("不能导出到原图片所在文件夹，以防止覆盖原图", file=sys.stderr)
+            return 2
+
+    os.makedirs(output_folder, exist_ok=True)
+    return run_with_report(args, lambda run, on_result, on_plan: run_incremental_export(
+        jobs, output_folder, run, on_result=on_result, force=args.force, on_plan=on_plan))
+
+
+def cmd_resume(args):
+    def start(run, on_result, on_plan):
+        return resume_export(args.output, run, on_result=on_result, on_plan=on_plan)
+
+    return run_with_report(args, start)
+
+
+def cmd_bench(args):
+    import benchmark  # 只在基准测试时导入，不拖慢其他子命令的启动
+
+    def log(msg):
+        if not args.quiet:
+            print(msg, file=sys.stderr)
+
+    try:
+        report = benchmark.run_benchmark(
+            megapixels_list=args.megapixels, modes=args.modes, formats=args.formats, repeat=args.repeat,
+            output_format=args.output_format, workers=args.jobs, batch_size=args.batch_size,
+            engine=args.engine, queue_size=args.queue_size, font_path=args.font, log=log)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    benchmark.write_report(report, args.json)
+    profiling.finish_batch()
+    return 0
+
+
+def cmd_watch(args):
+    try:
+        tpl, settings = settings_from_template(args.template)
+    except Exception as e:
+        print(f"加载模板失败: {e}", file=sys.stderr)
+        return 2
+
+    output_folder = args.output or tpl.get("output_folder", "")
+    if not output_folder:
+        print("请通过 --output 指定输出文件夹", file=sys.stderr)
+        return 2
+    for folder in args.input:
+        if not os.path.isdir(folder):
+            print(f"输入文件夹不存在: {folder}", file=sys.stderr)
+            return 2
+        if os.path.abspath(folder) == os.path.abspath(output_folder):
+            print("不能导出到原图片所在文件夹，以防止覆盖原图", file=sys.stderr)
+            return 2
+    if settings.watermark_type == IMAGE_WATERMARK and not os.path.isfile(settings.logo_path or ""):
+        print(f"水印图片不存在: {settings.logo_path}", file=sys.stderr)
+        return 2
+
+    # 第一次 Ctrl+C 或 SIGTERM：处理完在途图片后退出；再按一次 Ctrl+C 立即中断
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        if stop_event.is_set() and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        stop_event.set()
+        print("正在停止，等待处理中的图片完成...", file=sys.stderr)
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    def log(msg):
+        if not args.quiet:
+            print(msg, file=sys.stderr)
+
+    def on_result(result):
+        if result["ok"]:
+            if not args.quiet:
+                print(f"{result['image_path']} -> {result['output_path']}（{result['latency']:.2f} 秒）", flush=True)
+        else:
+            print(f"处理图片 {result['image_path']} 时出错: {result['error']}", file=sys.stderr, flush=True)
+
+    success_count, error_count = watch_folder.run_watch(
+        args.input, settings, output_folder, workers=args.jobs, recursive=args.recursive,
+        include=parse_patterns(args.include), exclude=parse_patterns(args.exclude), settle=args.settle,
+        poll=args.poll, poll_interval=args.poll_interval, max_memory_mb=args.max_memory,
+        on_result=on_result, log=log, stop_event=stop_event)
+    cprofile_path = profiling.finish_batch()
+    if cprofile_path:
+        print(f"cProfile 结果: {cprofile_path}", file=sys.stderr)
+    print(f"监视结束：成功 {success_count} 张，失败 {error_count} 张")
+    return 0
+
+
+def run_with_report(args, start):
+    """
+    执行 start(run, on_result, on_plan) 并在终端逐张输出结果与汇总。
+    start 返回 (成功数, 失败数, 跳过数)，或者在没有可继续的任务时返回 None。
+    """
+    progress = ExportProgress()
+    cache_stats = {}  # pid -> 该进程最新的缓存计数
+
+    def on_result(result):
+        progress.update(result)
+        if "cache_stats" in result:  # 主进程中判定失败的结果（如输出文件名冲突）没有缓存统计
+            cache_stats[result["pid"]] = result["cache_stats"]
+        if result["ok"]:
+            if not args.quiet:
+                print(f"[{progress.summary()}] {result['image_path']} -> {result['output_path']}")
+        else:
+            print(f"[{progress.summary()}] 处理图片 {result['image_path']} 时出错: {result['error']}",
+                  file=sys.stderr)
+
+    def on_plan(pending_count, skipped_count):
+        nonlocal progress
+        progress = ExportProgress(pending_count)  # 跳过的图片不计入进度
+
+    run = partial(run_export, workers=args.jobs, engine=args.engine, max_memory_mb=args.max_memory,
+                  queue_size=args.queue_size)
+    outcome = start(run, on_result, on_plan)
+    if outcome is None:
+        print("没有需要继续的导出任务", file=sys.stderr)
+        return 1
+    success_count, error_count, skipped_count = outcome
+    cprofile_path = profiling.finish_batch()
+    if cprofile_path:
+        print(f"cProfile 结果: {cprofile_path}", file=sys.stderr)
+    print(f"处理完成！成功: {success_count} 张，失败: {error_count} 张，未变化跳过: {skipped_count} 张，"
+          f"用时 {ExportProgress.format_seconds(progress.elapsed)}，"
+          f"{progress.images_per_second:.1f} 张/秒，{progress.mb_per_second:.1f} MB/s")
+    if args.stats:
+        for pid, info in sorted(cache_stats.items()):
+            tile, font = info["text_tile"], info["font"]
+            print(f"进程 {pid} 文字水印块缓存: 命中 {tile['hits']} 次，未命中 {tile['misses']} 次；"
+                  f"字体缓存: 命中 {font['hits']} 次，未命中 {font['misses']} 次")
+    return 0 if error_count == 0 else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="main.py", description="Photo Watermark 2 命令行模式")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    batch = subparsers.add_parser("batch", help="按模板批量添加水印")
+    batch.add_argument("--template", required=True, help="模板名称（templates/ 下）或模板 JSON 文件路径")
+    batch.add_argument("--input", required=True, nargs="+", help="输入图片文件或文件夹")
+    batch.add_argument("--output", help="输出文件夹（默认使用模板中的 output_folder）")
+    batch.add_argument("--force", action="store_true", help="忽略增量清单，重新导出所有图片")
+    batch.add_argument("--recursive", action="store_true", help="包括输入文件夹的子文件夹")
+    batch.add_argument("--include", help="只处理匹配的文件，通配符以分号分隔，如 \"IMG_*;*.jpg\"")
+    batch.add_argument("--exclude", help="跳过匹配的文件或文件夹，如 \"*/thumbs/*;*_small.*\"")
+    add_run_arguments(batch)
+    batch.set_defaults(func=cmd_batch)
+
+    resume = subparsers.add_parser("resume", help="继续输出文件夹中被中断的导出任务")
+    resume.add_argument("--output", required=True, help="被中断任务的输出文件夹")
+    add_run_arguments(resume)
+    resume.set_defaults(func=cmd_resume)
+
+    bench = subparsers.add_parser("bench", help="用合成图片测量各阶段耗时与吞吐，输出 JSON")
+    # 默认值与可选值见 benchmark.py（该模块只在执行 bench 时导入）
+    bench.add_argument("--megapixels", type=float, nargs="+",
+                       help="合成图片的像素数（百万），批量导出使用第一个（默认 1 12）")
+    bench.add_argument("--modes", nargs="+", help="合成图片的模式：RGB RGBA P L（默认全部）")
+    bench.add_argument("--formats", nargs="+", help="合成图片的保存格式：JPEG PNG（默认全部）")
+    bench.add_argument("--output-format", choices=OUTPUT_FORMATS, default="JPEG", help="导出格式")
+    bench.add_argument("--repeat", type=int, help="每个阶段的重复次数（默认 5）")
+    bench.add_argument("--batch-size", type=int, help="批量导出的图片数（默认进程数的 4 倍）")
+    bench.add_argument("--font", help="字体文件路径（默认自动查找系统字体）")
+    bench.add_argument("--json", help="结果写入该文件（默认输出到标准输出）")
+    add_run_arguments(bench)
+    bench.set_defaults(func=cmd_bench)
+
+    watch = subparsers.add_parser("watch", help="监视文件夹，新到达的图片写完后自动按模板添加水印")
+    watch.add_argument("--template", required=True, help="模板名称（templates/ 下）或模板 JSON 文件路径")
+    watch.add_argument("--input", required=True, nargs="+", help="要监视的文件夹")
+    watch.add_argument("--output", help="输出文件夹（默认使用模板中的 output_folder）")
+    watch.add_argument("--recursive", action="store_true", help="包括子文件夹（新建的子文件夹也会被监视）")
+    watch.add_argument("--include", help="只处理匹配的文件，通配符以分号分隔，如 \"IMG_*;*.jpg\"")
+    watch.add_argument("--exclude", help="跳过匹配的文件或文件夹，如 \"*/thumbs/*;*_small.*\"")
+    watch.add_argument("--settle", type=float, default=watch_folder.DEFAULT_SETTLE_SECONDS, metavar="SECONDS",
+                       help=f"文件大小与修改时间保持不变多久后视为写完（默认 {watch_folder.DEFAULT_SETTLE_SECONDS}）")
+    watch.add_argument("--poll", action="store_true", help="使用定时轮询而不是 inotify（如网络文件系统上）")
+    watch.add_argument("--poll-interval", type=float, default=watch_folder.DEFAULT_POLL_INTERVAL, metavar="SECONDS",
+                       help=f"轮询间隔（默认 {watch_folder.DEFAULT_POLL_INTERVAL}）")
+    add_run_arguments(watch, engine=False)
+    watch.set_defaults(func=cmd_watch)
+    return parser
+
+
+def add_run_arguments(parser, engine=True):
+    parser.add_argument("--jobs", type=int, default=default_worker_count(), help="并行进程数（默认 CPU 核数）")
+    if engine:
+        parser.add_argument("--engine", choices=ENGINES, default="process",
+                            help="process：进程池（默认）；pipeline：读取/渲染/写出分阶段的线程流水线")
+        parser.add_argument("--queue-size", type=int, default=None, metavar="N",
+                            help="pipeline 阶段间队列容量，决定同时驻留内存的已解码图片数（默认等于 --jobs）")
+    parser.add_argument("--max-memory", type=int, default=DEFAULT_MAX_MEMORY_MB, metavar="MB",
+                        help=f"每个进程处理单张图片的内存上限，超过的图片记为失败而不会拖垮整批（默认 {DEFAULT_MAX_MEMORY_MB}，0 为不限制）")
+    parser.add_argument("--compositor", choices=COMPOSITORS, default=None,
+                        help="水印混合实现：pillow（默认）或 numpy（需安装 NumPy），两者输出一致")
+    parser.add_argument("--quiet", action="store_true", help="只输出错误与汇总")
+    parser.add_argument("--stats", action="store_true", help="结束时输出每个进程的缓存统计")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="统计各阶段耗时直方图并写入 JSON 文件（为 1 时输出到标准错误）")
+    parser.add_argument("--cprofile", metavar="DIR", help="每个批次在 DIR 中生成合并后的 cProfile 结果")
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # 在创建进程池之前设置，子进程才能继承
+    profiling.configure(args.profile, args.cprofile)
+    if args.compositor:
+        try:
+            set_compositor(args.compositor)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
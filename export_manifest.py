@@ -0,0 +1,339 @@
+# export_manifest.py
+# ----------------------
+# 增量导出清单
+# 在输出文件夹中记录每张源图的 mtime/大小、所用设置的哈希以及输出文件名（相对输出文件夹的路径），
+# 再次导出时跳过源图与设置都没有变化、且输出文件仍存在并由该源图写出的图片。
+# 每个输出文件只属于一个源图：导出前检查输出文件名冲突，冲突的图片记为失败而不是互相覆盖。
+#
+# 崩溃安全：每完成一张就向日志文件追加一行，清单只在导出结束时合并重写；
+# 导出开始时把任务列表写入任务文件，正常结束后删除。
+# 进程崩溃或断电后任务文件仍在，resume_export() 读取它并借助清单与日志跳过已完成的图片。
+# ----------------------
+import os
+import re
+import json
+import time
+import hashlib
+
+from template_store import write_json_atomic
+from export_pool import failed_result
+from watermark_engine import WatermarkSettings, IMAGE_WATERMARK, output_path_for
+
+MANIFEST_FILENAME = ".photowatermark_manifest.json"
+JOURNAL_FILENAME = ".photowatermark_manifest.journal"
+JOB_FILENAME = ".photowatermark_job.json"
+MANIFEST_VERSION = 1
+# save_image 写出时使用的临时文件名（见 watermark_engine.save_image）
+TEMP_OUTPUT_RE = re.compile(r"^\.[0-9a-f]{32}\.tmp$")
+JOURNAL_FSYNC_INTERVAL = 1.0  # 秒；断电最多丢失这段时间内的记录，对应图片会被重新导出
+
+
+def settings_hash(settings):
+    """
+    WatermarkSettings 的稳定哈希（字段按名称排序后序列化）。
+    图片水印另外计入水印图片的修改时间与大小，替换 logo 文件后会重新导出。
+    """
+    tpl = settings.to_template()
+    if settings.watermark_type == IMAGE_WATERMARK and settings.logo_path:
+        try:
+            st = os.stat(settings.logo_path)
+            tpl["logo_stat"] = [st.st_mtime_ns, st.st_size]
+        except OSError:
+            pass
+    payload = json.dumps(tpl, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def source_key(image_path):
+    return os.path.abspath(image_path)
+
+
+def _output_key(output):
+    # 大小写不敏感的文件系统上 IMG.jpeg 与 img.jpeg 是同一个文件
+    return os.path.normcase(output)
+
+
+class ExportManifest:
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, MANIFEST_FILENAME)
+        self.journal_path = os.path.join(output_folder, JOURNAL_FILENAME)
+        self.journal = None
+        self.last_fsync = 0.0
+        self.entries = {}
+        self.owners = {}  # 输出文件 -> 写出它的源图；被多个条目声明的输出（旧版清单）为 None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data.get("entries", {})
+        except Exception:
+            self.entries = {}  # 清单缺失或损坏时视为全部需要导出
+        # 重放上次未合并的日志（崩溃时最后一行可能不完整，忽略即可）
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        key, entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry is None:
+                        self.entries.pop(key, None)  # 输出文件已被其他源图接管
+                    else:
+                        self.entries[key] = entry
+        except OSError:
+            pass
+        for key, entry in self.entries.items():
+            output = entry.get("output")
+            if output:
+                out_key = _output_key(output)
+                self.owners[out_key] = None if out_key in self.owners else key
+
+    def save(self):
+        """把日志合并进清单并删除日志"""
+        self.close_journal()
+        write_json_atomic(self.path, {"version": MANIFEST_VERSION, "entries": self.entries})
+        try:
+            os.remove(self.journal_path)
+        except OSError:
+            pass
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal.close()
+            self.journal = None
+
+    def _append_journal(self, key, entry):
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+        self.journal.write(json.dumps([key, entry], ensure_ascii=False) + "\n")
+        self.journal.flush()
+        now = time.monotonic()
+        if now - self.last_fsync >= JOURNAL_FSYNC_INTERVAL:
+            os.fsync(self.journal.fileno())
+            self.last_fsync = now
+
+    def is_up_to_date(self, job, stat):
+        entry = self.entries.get(source_key(job["image_path"]))
+        if entry is None:
+            return False
+        if entry.get("mtime_ns") != stat.st_mtime_ns or entry.get("size") != stat.st_size:
+            return False
+        if entry.get("settings_hash") != settings_hash(job["settings"]):
+            return False
+        output = entry.get("output")
+        if not output or self.owners.get(_output_key(output)) != source_key(job["image_path"]):
+            return False
+        return os.path.isfile(os.path.join(self.output_folder, output))
+
+    def relative_output(self, output_path):
+        return os.path.relpath(output_path, self.output_folder).replace(os.sep, "/")
+
+    def claimed_by_other(self, job):
+        """输出文件已由另一张仍然存在的源图写出时返回该源图路径，否则返回 None"""
+        output = self.relative_output(output_path_for(job["image_path"], job["settings"], job["output_folder"]))
+        owner = self.owners.get(_output_key(output))
+        if owner is None or owner == source_key(job["image_path"]) or not os.path.isfile(owner):
+            return None
+        return owner
+
+    def record(self, job, output_path):
+        """记录一张成功导出的图片，使用规划时的源文件状态，避免与导出期间的修改混淆"""
+        mtime_ns, size = job["source_stat"]
+        key = source_key(job["image_path"])
+        output = self.relative_output(output_path)
+        out_key = _output_key(output)
+        # 输出文件被本图覆盖，原先声明它的其他源图的记录作废（旧版清单中可能有多条）
+        if out_key in self.owners and self.owners[out_key] != key:
+            for other, other_entry in list(self.entries.items()):
+                if other != key and _output_key(other_entry.get("output") or "") == out_key:
+                    del self.entries[other]
+                    self._append_journal(other, None)
+        old_entry = self.entries.get(key)
+        if old_entry and old_entry.get("output") and self.owners.get(_output_key(old_entry["output"])) == key:
+            del self.owners[_output_key(old_entry["output"])]
+        entry = {
+            "mtime_ns": mtime_ns,
+            "size": size,
+            "settings_hash": settings_hash(job["settings"]),
+            "output": output,
+        }
+        self.entries[key] = entry
+        self.owners[out_key] = key
+        self._append_journal(key, entry)
+
+    def split_unchanged(self, jobs):
+        """返回 (需要导出的任务, 可跳过的任务)，并在任务中记下源文件状态"""
+        pending = []
+        skipped = []
+        for job in jobs:
+            try:
+                stat = os.stat(job["image_path"])
+            except OSError:
+                pending.append(job)  # 交给导出流程报告错误
+                continue
+            job["source_stat"] = (stat.st_mtime_ns, stat.st_size)
+            if self.is_up_to_date(job, stat):
+                skipped.append(job)
+            else:
+                pending.append(job)
+        return pending, skipped
+
+
+def output_conflict_error(output_path, other):
+    return f"输出文件 {os.path.basename(output_path)} 与 {other} 的输出重名，已跳过"
+
+
+def split_output_conflicts(jobs, manifest=None):
+    """
+    返回 (无冲突的任务, [(冲突的任务, 错误信息)])。
+    多张源图的输出文件相同时（如不同文件夹中的同名文件、同名的 .jpg 与 .png）只保留第一张；
+    给出 manifest 时，输出文件已由另一张仍存在的源图写出的任务也视为冲突。
+    """
+    accepted = []
+    conflicts = []
+    claimed = {}  # 输出路径 -> 源图
+    for job in jobs:
+        output_path = output_path_for(job["image_path"], job["settings"], job["output_folder"])
+        out_key = _output_key(os.path.abspath(output_path))
+        other = claimed.get(out_key)
+        if other is None and manifest is not None:
+            other = manifest.claimed_by_other(job)
+        if other is not None:
+            conflicts.append((job, output_conflict_error(output_path, other)))
+            continue
+        claimed[out_key] = job["image_path"]
+        accepted.append(job)
+    return accepted, conflicts
+
+
+# ----------------------
+# 未完成任务文件
+# ----------------------
+def job_file_path(output_folder):
+    return os.path.join(output_folder, JOB_FILENAME)
+
+
+def save_pending_job(output_folder, jobs):
+    """记录本次导出的全部任务；相同的设置只保存一份"""
+    settings_list = []
+    settings_index = {}
+    items = []
+    for job in jobs:
+        settings = job["settings"]
+        idx = settings_index.get(settings)
+        if idx is None:
+            idx = settings_index[settings] = len(settings_list)
+            settings_list.append(settings.to_template())
+        item = [job["image_path"], idx]
+        # 镜像目录结构时记下输出子目录
+        subfolder = os.path.relpath(job["output_folder"], output_folder)
+        if subfolder != os.curdir:
+            item.append(subfolder.replace(os.sep, "/"))
+        items.append(item)
+    write_json_atomic(job_file_path(output_folder), {
+        "version": MANIFEST_VERSION,
+        "created": time.time(),
+        "settings": settings_list,
+        "items": items,
+    })
+
+
+def load_pending_job(output_folder):
+    """读取未完成的任务，返回任务列表；没有未完成任务时返回 None"""
+    try:
+        with open(job_file_path(output_folder), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != MANIFEST_VERSION:
+        return None
+    settings_list = [WatermarkSettings.from_template(tpl) for tpl in data.get("settings", [])]
+    return [{"image_path": item[0], "settings": settings_list[item[1]],
+             "output_folder": os.path.join(output_folder, item[2]) if len(item) > 2 else output_folder}
+            for item in data.get("items", [])]
+
+
+def has_pending_job(output_folder):
+    return os.path.isfile(job_file_path(output_folder))
+
+
+def clear_pending_job(output_folder):
+    try:
+        os.remove(job_file_path(output_folder))
+    except OSError:
+        pass
+
+
+def remove_stale_temp_files(output_folder):
+    """删除被中断的导出遗留下的临时输出文件（包括镜像目录结构时的子目录）"""
+    for folder, _, names in os.walk(output_folder):
+        for name in names:
+            if TEMP_OUTPUT_RE.match(name):
+                try:
+                    os.remove(os.path.join(folder, name))
+                except OSError:
+                    pass
+
+
+def resume_export(output_folder, run, on_result=None, on_plan=None):
+    """继续 output_folder 中未完成的导出；没有未完成任务时返回 None"""
+    jobs = load_pending_job(output_folder)
+    if jobs is None:
+        return None
+    remove_stale_temp_files(output_folder)
+    return run_incremental_export(jobs, output_folder, run, on_result=on_result, on_plan=on_plan)
+
+
+def run_incremental_export(jobs, output_folder, run, on_result=None, force=False, on_plan=None):
+    """
+    用 run(jobs, on_result) 执行导出（如 functools.partial(run_export, workers=N)），
+    跳过未变化的图片并在结束后更新清单。开始导出前调用 on_plan(待导出数, 跳过数)。
+    输出文件名冲突的图片不导出，直接作为失败结果回调（计入待导出数与失败数）。
+    导出过程中任务文件与日志保证中断后可以用 resume_export() 继续。
+    返回 (成功数, 失败数, 跳过数)。
+    """
+    manifest = ExportManifest(output_folder)
+    # force 时忽略清单，只检查本批次内的冲突
+    jobs, conflicts = split_output_conflicts(jobs, None if force else manifest)
+    save_pending_job(output_folder, jobs)
+    if force:
+        for job in jobs:
+            try:
+                stat = os.stat(job["image_path"])
+                job["source_stat"] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                pass
+        pending, skipped = list(jobs), []
+    else:
+        pending, skipped = manifest.split_unchanged(jobs)
+    jobs_by_path = {job["image_path"]: job for job in pending}
+    if on_plan is not None:
+        on_plan(len(pending) + len(conflicts), len(skipped))
+    if on_result is not None:
+        for job, error in conflicts:
+            on_result(failed_result(job["image_path"], error, rendered=False))
+
+    def handle(result):
+        job = jobs_by_path.get(result["image_path"])
+        if result["ok"] and job is not None and "source_stat" in job:
+            manifest.record(job, result["output_path"])
+        if on_result is not None:
+            on_result(result)
+
+    try:
+        success_count, error_count = run(pending, on_result=handle)
+    except BaseException:
+        # 中断时保留任务文件与日志，下次可继续
+        manifest.close_journal()
+        raise
+    manifest.save()
+    if success_count + error_count >= len(pending):
+        clear_pending_job(output_folder)
+    # 否则导出被取消，保留任务文件以便之后继续
+    return success_count, error_count + len(conflicts), len(skipped)
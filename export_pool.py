@@ -0,0 +1,397 @@
+# export_pool.py
+# ----------------------
+# 多进程批量导出
+# 任务描述是普通 dict（WatermarkSettings + 路径），可以被 pickle 后发送到子进程。
+# 本模块不依赖 PyQt5，子进程中不会加载 GUI。
+# ----------------------
+import os
+import time
+import queue
+import signal
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import profiling
+from watermark_engine import (render_file, cache_info, open_image, render, save_image,
+                              output_path_for, DEFAULT_MAX_MEMORY_MB)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ENGINES = ["process", "pipeline"]
+
+
+def default_worker_count():
+    return os.cpu_count() or 1
+
+
+def make_job(image_path, settings, output_folder, subfolder=""):
+    """
+    构造一个可 pickle 的导出任务。
+    subfolder 为输出文件夹下的相对子目录：递归导入时按源文件相对扫描根目录的位置镜像目录结构，
+    不同子目录中的同名文件不会写到同一个输出文件。
+    """
+    return {
+        "image_path": image_path,
+        "settings": settings,
+        "output_folder": os.path.join(output_folder, subfolder) if subfolder else output_folder,
+    }
+
+
+def _new_result(image_path):
+    try:
+        size = os.path.getsize(image_path)
+    except OSError:
+        size = 0
+    return {"image_path": image_path, "output_path": None, "ok": False, "error": None,
+            "pid": os.getpid(), "bytes": size}
+
+
+def failed_result(image_path, error, rendered=True):
+    """
+    在主进程中构造的失败结果（任务没有交给子进程，或处理它的子进程异常退出）。
+    rendered 为 False 表示图片根本没有开始处理（如输出文件名冲突），不计入速度与字节统计。
+    """
+    result = _new_result(image_path)
+    result["error"] = error
+    if not rendered:
+        result["rendered"] = False
+        result["bytes"] = 0
+    return result
+
+
+def _cancelled(cancel_event):
+    return cancel_event is not None and cancel_event.is_set()
+
+
+def _limit_worker_memory(max_memory_mb):
+    """
+    进程池子进程的初始化函数：在按图像头估算之外再加一道保险，限制进程的虚拟地址空间，
+    使估算不到的超限分配变成该图片的 MemoryError，而不是整个进程被系统 OOM 杀掉。
+    只在支持 RLIMIT_AS 的平台（Linux）上生效。
+    """
+    if resource is None or not max_memory_mb or not hasattr(resource, "RLIMIT_AS"):
+        return
+    try:
+        with open("/proc/self/statm") as f:
+            baseline = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return
+    # 上限之外留出编码缓冲与内存碎片的余量
+    limit = baseline + 2 * max_memory_mb * 1024 * 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    if soft == resource.RLIM_INFINITY or limit < soft:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _init_worker(max_memory_mb, ignore_sigint):
+    if ignore_sigint:
+        # 常驻服务中 Ctrl+C 由主进程处理：等在途图片完成后再退出，子进程不应被同时中断
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # fork 出的子进程会继承主进程安装的处理函数（如 watch 的停止逻辑），SIGTERM 恢复默认；
+    # 进程池在异常时也靠 SIGTERM 结束子进程
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _limit_worker_memory(max_memory_mb)
+
+
+def make_executor(workers, max_memory_mb=None, ignore_sigint=False):
+    """创建导出用的进程池，子进程启动时设置内存上限（见 _limit_worker_memory）"""
+    if max_memory_mb is None:
+        max_memory_mb = DEFAULT_MAX_MEMORY_MB
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(max_memory_mb, ignore_sigint))
+
+
+def export_one(job, max_memory_mb=None):
+    """子进程入口：处理单个任务，异常不外抛，统一放进结果 dict"""
+    image_path = job["image_path"]
+    result = _new_result(image_path)
+    try:
+        with profiling.cprofiled(), profiling.stage("total"):
+            result["output_path"] = render_file(image_path, job["settings"], job["output_folder"],
+                                                max_memory_mb)
+        result["ok"] = True
+    except MemoryError:
+        result["error"] = "内存不足，图片过大（可调高单进程内存上限或减少并行进程数）"
+    except Exception as e:
+        result["error"] = str(e)
+    result["cache_stats"] = cache_info()
+    if profiling.ENABLED:
+        result["profile"] = profiling.drain()  # 交给主进程合并
+    return result
+
+
+def run_export(jobs, workers=None, on_result=None, engine="process", cancel_event=None, max_memory_mb=None,
+               queue_size=None):
+    """
+    并行执行导出任务。每完成一张就调用 on_result(result)。
+    engine 为 "process" 时使用进程池，每个进程完整处理一张图；
+    为 "pipeline" 时使用分阶段的线程流水线（见 run_pipeline）。
+    workers <= 1 时直接在当前进程中顺序执行，省去启动进程池的开销。
+    cancel_event（threading.Event）被置位后不再开始新的图片，已在处理中的图片会正常完成。
+    max_memory_mb 为每个进程处理单张图片的内存上限（None 为默认值，0 为不限制），超过的图片记为失败。
+    queue_size 只用于 pipeline，见 run_pipeline。
+    返回 (成功数, 失败数)。
+    """
+    if max_memory_mb is None:
+        max_memory_mb = DEFAULT_MAX_MEMORY_MB
+    if engine == "pipeline":
+        return run_pipeline(jobs, workers, workers, workers, queue_size=queue_size, on_result=on_result,
+                            cancel_event=cancel_event, max_memory_mb=max_memory_mb)
+    jobs = list(jobs)
+    workers = workers or default_worker_count()
+    workers = max(1, min(workers, len(jobs) or 1))
+    success_count = 0
+    error_count = 0
+
+    def handle(result):
+        nonlocal success_count, error_count
+        profile = result.pop("profile", None)
+        if profile:
+            profiling.merge(profile)
+        if result["ok"]:
+            success_count += 1
+        else:
+            error_count += 1
+        if on_result is not None:
+            on_result(result)
+
+    if workers == 1:
+        for job in jobs:
+            if _cancelled(cancel_event):
+                break
+            handle(export_one(job, max_memory_mb))
+        return success_count, error_count
+
+    # 只保持少量任务在途，便于及时取消，也避免一次创建大量 Future
+    job_iter = iter(jobs)
+    in_flight = {}  # future -> job
+    executor = make_executor(workers, max_memory_mb)
+
+    def submit_next():
+        nonlocal executor
+        if _cancelled(cancel_event):
+            return False
+        job = next(job_iter, None)
+        if job is None:
+            return False
+        try:
+            future = executor.submit(export_one, job, max_memory_mb)
+        except BrokenProcessPool:
+            executor.shutdown(wait=False)
+            executor = make_executor(workers, max_memory_mb)
+            future = executor.submit(export_one, job, max_memory_mb)
+        in_flight[future] = job
+        return True
+
+    try:
+        for _ in range(workers * 2):
+            if not submit_next():
+                break
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    # 某个子进程被系统杀掉（如内存耗尽）或崩溃：无法得知是哪张图片引起的，
+                    # 在途的图片都记为失败；下一次提交时换一个新的进程池，其余图片继续导出
+                    result = failed_result(job["image_path"], f"处理进程异常退出: {e}")
+                handle(result)
+                submit_next()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return success_count, error_count
+
+
+# ----------------------
+# 流水线导出
+# 读取/解码、渲染、编码/写出三个阶段各有自己的线程池，阶段之间用有界队列连接：
+# 下游变慢时上游会阻塞（背压），同时驻留在内存中的图片数量有上限。
+# Pillow 在解码、合成和编码时会释放 GIL，因此线程能利用多核，
+# 网络盘上的读写也能与 CPU 密集的编码重叠进行。
+# ----------------------
+_STAGE_DONE = object()
+
+
+def _read_stage(job, _, max_memory_mb=None):
+    return open_image(job["image_path"], job["settings"], max_memory_mb)
+
+
+def _render_stage(job, img):
+    watermarked = None
+    try:
+        watermarked = render(img, job["settings"], in_place=True)
+        return watermarked
+    finally:
+        # in_place 时结果可能就是原图对象，此时交给写出阶段，不能关闭
+        if watermarked is not img:
+            img.close()
+
+
+def _write_stage(job, watermarked):
+    settings = job["settings"]
+    result = _new_result(job["image_path"])
+    output_path = output_path_for(job["image_path"], settings, job["output_folder"])
+    try:
+        save_image(watermarked, output_path, settings)
+    finally:
+        watermarked.close()
+    result["output_path"] = output_path
+    result["ok"] = True
+    result["cache_stats"] = cache_info()
+    return result
+
+
+def run_pipeline(jobs, read_workers=None, render_workers=None, write_workers=None,
+                 queue_size=None, on_result=None, cancel_event=None, max_memory_mb=None):
+    """
+    以流水线方式执行导出任务，on_result 在调用线程中按完成顺序回调。
+    queue_size 为阶段间队列的容量（默认等于渲染线程数）。同时在内存中的已解码/已渲染图片
+    至多为 2 * queue_size 加上三个阶段的线程数，因此内存占用随 --jobs 而不是 CPU 核数增长。
+    cancel_event 被置位后读取阶段不再读入新图片，已读入的图片会正常写出。
+    max_memory_mb 在读取阶段按图像头检查，超限的图片不解码、直接记为失败。
+    返回 (成功数, 失败数)。
+    """
+    jobs = list(jobs)
+    n = default_worker_count()
+    read_workers = max(1, read_workers or n)
+    render_workers = max(1, render_workers or n)
+    write_workers = max(1, write_workers or n)
+    queue_size = max(1, queue_size or render_workers)
+
+    job_q = queue.Queue()
+    for job in jobs:
+        job_q.put((job, None))
+    for _ in range(read_workers):
+        job_q.put(_STAGE_DONE)
+    decoded_q = queue.Queue(maxsize=queue_size)
+    rendered_q = queue.Queue(maxsize=queue_size)
+    result_q = queue.Queue()
+
+    lock = threading.Lock()
+
+    def start_stage(name, worker_count, in_q, out_q, next_worker_count, work, stop_event=None):
+        remaining = [worker_count]
+
+        def worker():
+            # 多个线程同时运行，cProfile 按线程采样而不是按任务（见 profiling.cprofiled_thread）
+            with profiling.cprofiled_thread():
+                while True:
+                    item = in_q.get()
+                    if item is _STAGE_DONE:
+                        break
+                    if _cancelled(stop_event):
+                        continue  # 取消后丢弃剩余任务，直到收到结束标记
+                    job, payload = item
+                    try:
+                        out = work(job, payload)
+                    except Exception as e:
+                        result = _new_result(job["image_path"])
+                        result["error"] = str(e)
+                        result["cache_stats"] = cache_info()
+                        result_q.put((job, result))
+                        continue
+                    out_q.put((job, out))
+            # 本阶段最后一个结束的线程通知下游所有线程结束
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                for _ in range(next_worker_count):
+                    out_q.put(_STAGE_DONE)
+
+        threads = [threading.Thread(target=worker, name=f"{name}-{i}", daemon=True)
+                   for i in range(worker_count)]
+        for t in threads:
+            t.start()
+        return threads
+
+    with profiling.cprofiled_threads():
+        threads = []
+        threads += start_stage("read", read_workers, job_q, decoded_q, render_workers,
+                               partial(_read_stage, max_memory_mb=max_memory_mb), cancel_event)
+        threads += start_stage("render", render_workers, decoded_q, rendered_q, write_workers, _render_stage)
+        threads += start_stage("write", write_workers, rendered_q, result_q, 1, _write_stage)
+
+        success_count = 0
+        error_count = 0
+        while True:
+            item = result_q.get()
+            if item is _STAGE_DONE:
+                break
+            result = item[1]
+            if result["ok"]:
+                success_count += 1
+            else:
+                error_count += 1
+            if on_result is not None:
+                on_result(result)
+        for t in threads:
+            t.join()
+    return success_count, error_count
+
+
+# ----------------------
+# 导出进度统计（GUI 与命令行共用）
+# ----------------------
+class ExportProgress:
+    def __init__(self, total=0):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.rendered = 0  # 实际处理过的图片数，速度只按这些计算
+        self.bytes_done = 0
+        self.errors = []  # [(image_path, error)]
+        self.start_time = time.monotonic()
+
+    def update(self, result):
+        self.done += 1
+        if result.get("rendered", True):
+            self.rendered += 1
+            self.bytes_done += result.get("bytes", 0)
+        if not result["ok"]:
+            self.failed += 1
+            self.errors.append((result["image_path"], result["error"]))
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    @property
+    def images_per_second(self):
+        elapsed = self.elapsed
+        return self.rendered / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def mb_per_second(self):
+        elapsed = self.elapsed
+        return self.bytes_done / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta_seconds(self):
+        """剩余时间估计；还没有完成任何图片时返回 None"""
+        rate = self.images_per_second
+        if rate <= 0:
+            return None
+        return max(0, self.total - self.done) / rate
+
+    @staticmethod
+    def format_seconds(seconds):
+        if seconds is None:
+            return "--:--"
+        seconds = int(round(seconds))
+        h, rem = divmod(seconds, 3600)
+        m, s = divmod(rem, 60)
+        return f"{h}:{m:02d}:{s:02d}" if h else f"{m:02d}:{s:02d}"
+
+    def summary(self):
+        return (f"{self.done}/{self.total}，{self.images_per_second:.1f} 张/秒，"
+                f"{self.mb_per_second:.1f} MB/s，剩余 {self.format_seconds(self.eta_seconds)}")
@@ -0,0 +1,117 @@
+# file_scanner.py
+# ----------------------
+# 图片文件扫描（不依赖 PyQt5）
+# 用 os.scandir 单次遍历目录树：扩展名不区分大小写，可选递归，支持包含/排除通配符。
+# 结果按块产出，调用方（GUI 后台线程或命令行）可以边扫描边处理，十万级文件也不必等全部扫完。
+# ----------------------
+import os
+from fnmatch import fnmatchcase
+
+from watermark_engine import SUPPORTED_EXTENSIONS
+
+SCAN_CHUNK_SIZE = 500
+
+
+def parse_patterns(text):
+    """把 "*.jpg; IMG_*" 这样以分号或逗号分隔的文本拆成通配符列表"""
+    if not text:
+        return []
+    return [p.strip() for p in text.replace(",", ";").split(";") if p.strip()]
+
+
+def _matches(patterns, rel_path, name):
+    # 通配符既可以匹配文件名（IMG_*），也可以匹配相对路径（raw/*、*/thumbs/*）；不区分大小写。
+    # 相对路径另以 "/" 开头再匹配一次，使 */thumbs/* 也能匹配第一层的 thumbs 目录
+    rel_path = rel_path.lower()
+    name = name.lower()
+    return any(fnmatchcase(name, p) or fnmatchcase(rel_path, p) or fnmatchcase("/" + rel_path, p)
+               for p in patterns)
+
+
+def scan_images(root, recursive=False, extensions=SUPPORTED_EXTENSIONS, include=None, exclude=None,
+                chunk_size=SCAN_CHUNK_SIZE, should_stop=None):
+    """
+    遍历 root，按块产出图片路径列表（每块至多 chunk_size 个）。
+    每个目录内按文件名排序，先文件后子目录（深度优先），结果顺序稳定。
+    include 非空时只保留匹配的文件；匹配 exclude 的文件和目录被跳过（目录整棵剪掉）。
+    不跟随目录符号链接，避免循环；无权限的目录被静默跳过。
+    should_stop() 返回 True 时提前结束。
+    """
+    extensions = {ext.lower() for ext in extensions}
+    include = [p.lower() for p in include or []]
+    exclude = [p.lower() for p in exclude or []]
+    chunk = []
+    stack = [(root, "")]
+    while stack:
+        if should_stop is not None and should_stop():
+            return
+        folder, rel_folder = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subfolders = []
+        for entry in entries:
+            rel_path = f"{rel_folder}{entry.name}"
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    # 目录以 "/" 结尾参与匹配，*/thumbs/* 这样的模式可以直接剪掉整个目录
+                    if recursive and not (exclude and _matches(exclude, rel_path + "/", entry.name)):
+                        subfolders.append((entry.path, rel_path + "/"))
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if os.path.splitext(entry.name)[1].lower() not in extensions:
+                continue
+            if include and not _matches(include, rel_path, entry.name):
+                continue
+            if exclude and _matches(exclude, rel_path, entry.name):
+                continue
+            chunk.append(entry.path)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        # 逆序入栈，使子目录按名称顺序被处理
+        stack.extend(reversed(subfolders))
+    if chunk:
+        yield chunk
+
+
+def is_image_candidate(rel_path, extensions=SUPPORTED_EXTENSIONS, include=None, exclude=None):
+    """
+    对单个文件做与 scan_images 相同的判断（监视文件夹时逐个到达的文件使用）。
+    rel_path 为相对扫描根目录、以 "/" 分隔的路径；所在的任一级目录被 exclude 排除时同样返回 False。
+    """
+    name = rel_path.rsplit("/", 1)[-1]
+    if os.path.splitext(name)[1].lower() not in {ext.lower() for ext in extensions}:
+        return False
+    include = [p.lower() for p in include or []]
+    exclude = [p.lower() for p in exclude or []]
+    if exclude:
+        parts = rel_path.split("/")
+        for i in range(1, len(parts)):
+            if _matches(exclude, "/".join(parts[:i]) + "/", parts[i - 1]):
+                return False
+        if _matches(exclude, rel_path, name):
+            return False
+    return not include or _matches(include, rel_path, name)
+
+
+def relative_subfolder(path, root):
+    """path 所在目录相对扫描根目录 root 的路径；直接位于 root 下时返回空字符串"""
+    folder = os.path.dirname(path)
+    if folder == root:
+        return ""
+    rel = os.path.relpath(folder, root)
+    return "" if rel == os.curdir else rel
+
+
+def scan_image_list(root, **kwargs):
+    """一次性返回全部结果"""
+    files = []
+    for chunk in scan_images(root, **kwargs):
+        files.extend(chunk)
+    return files
@@ -1,59 +1,41 @@
 # main.py
 import sys
 import os
-import glob
 import json
 import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from functools import partial
+
+# 命令行模式（如 `python main.py batch ...`）在导入 PyQt5 之前分流，
+# 这样在没有显示环境的服务器上也能快速启动
+if __name__ == '__main__' and len(sys.argv) > 1 and not sys.argv[1].startswith('-'):
+    multiprocessing.freeze_support()
+    import cli
+    sys.exit(cli.main(sys.argv[1:]))
+
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                              QHBoxLayout, QPushButton, QFileDialog, QListWidget,
-                             QListWidgetItem, QLabel, QComboBox, QLineEdit,
-                             QGroupBox, QFormLayout, QSpinBox,
-                             QColorDialog, QMessageBox, QSplitter, QInputDialog)
-from PyQt5.QtGui import QPixmap, QFont, QColor, QIcon, QPainter, QFontMetrics, QFontDatabase
-from PyQt5.QtCore import Qt, QSize, QPoint, QRect, pyqtSignal
-from PIL import Image, ImageDraw, ImageFont
-
-# ----------------------
-# 配置：模板目录与 last used 文件名
-# ----------------------
-import sys
-
-def get_templates_dir():
-    # 如果是打包后的 exe，sys._MEIPASS 或 sys.argv[0] 会指向 exe 所在目录
-    if getattr(sys, 'frozen', False):
-        # exe 文件所在目录
-        exe_dir = os.path.dirname(sys.executable)
-        return os.path.join(exe_dir, "templates")
-    else:
-        # 普通脚本模式
-        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
-
-TEMPLATES_DIR = get_templates_dir()
-os.makedirs(TEMPLATES_DIR, exist_ok=True)
-
-LAST_USED_FILENAME = "last_used.json"
-
-# ----------------------
-# 帮助寻找系统字体路径（常见位置）
-# ----------------------
-def find_system_font_path():
-    candidates = [
-        # Windows 常见
-        r"C:\Windows\Fonts\arial.ttf",
-        r"C:\Windows\Fonts\ARIAL.TTF",
-        r"C:\Windows\Fonts\msyh.ttf",
-        # Linux 常见
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-        "/usr/share/fonts/truetype/freefont/FreeSans.ttf",
-        # macOS 常见
-        "/Library/Fonts/Arial.ttf",
-        "/System/Library/Fonts/SFNSText.ttf",
-        "/System/Library/Fonts/Helvetica.ttc",
-    ]
-    for p in candidates:
-        if os.path.exists(p):
-            return p
-    return None
+                             QListView, QLabel, QComboBox, QLineEdit,
+                             QGroupBox, QFormLayout, QSpinBox, QCheckBox,
+                             QColorDialog, QMessageBox, QSplitter, QInputDialog,
+                             QDialog, QProgressBar)
+from PyQt5.QtGui import (QPixmap, QFont, QColor, QIcon, QPainter, QFontMetrics, QFontDatabase, QImage,
+                         QImageReader, QBrush, QTransform)
+from PyQt5.QtCore import (Qt, QSize, QPoint, QRect, pyqtSignal, QThread, QObject, QRunnable,
+                          QThreadPool, QTimer, QAbstractListModel, QModelIndex)
+from export_pool import default_worker_count, make_job, run_export, ExportProgress
+from export_manifest import run_incremental_export, resume_export, has_pending_job
+from file_scanner import scan_images, parse_patterns, relative_subfolder
+from thumbnails import THUMBNAIL_SIZE, ThumbnailCache, load_thumbnail
+import profiling
+from template_store import (TEMPLATES_DIR, LAST_USED_FILENAME, THUMBNAIL_CACHE_PATH, template_file_path,
+                            write_json_atomic, DebouncedJsonWriter)
+from watermark_engine import (WatermarkSettings, POSITIONS, ENCODE_PRESETS, JPEG_SUBSAMPLINGS,
+                              SUPPORTED_EXTENSIONS, DEFAULT_MAX_MEMORY_MB, available_output_formats,
+                              TILED_POSITION, WATERMARK_TYPES, IMAGE_WATERMARK, find_system_font_path,
+                              compute_position, get_pattern_cell, get_logo_tile, render_file)
 
 # ----------------------
 # 可拖拽且直接绘制水印的预览 QLabel
@@ -79,6 +61,12 @@ class WatermarkPreviewLabel(QLabel):
 
         # 字体家族（若通过 QFontDatabase 注册了外部字体，会放这里）
         self.font_family = None
+        # 平铺模式的图案单元由渲染引擎用该字体生成，与导出结果一致
+        self.font_path = None
+        self.tile_params = (WatermarkSettings.tile_spacing, WatermarkSettings.tile_angle,
+                            WatermarkSettings.tile_stagger)  # (间距, 角度, 错行)
+        # 图片水印：(水印类型, 图片路径, 宽度百分比)，缩放由渲染引擎完成并缓存
+        self.logo_params = (WatermarkSettings.watermark_type, None, WatermarkSettings.logo_scale)
 
         # custom position（原图像像素坐标，中心点锚）
         self.custom_pos = None
@@ -90,23 +78,68 @@ class WatermarkPreviewLabel(QLabel):
         # 用于点击检测的上次文字矩形（display coords）
         self.last_text_rect = None
 
+        # 预渲染的水印文字及其缓存键；sprite_rect 为其在控件中的位置（无效时在绘制前重新计算）
+        self.text_sprite = None
+        self.sprite_key = None
+        self.sprite_offset = QPoint(0, 0)
+        self.text_size = (0, 0)
+        self.sprite_rect = QRect()
+
+        # 平铺模式：引擎缓存的图案单元缩放到显示比例后作为纹理画刷
+        self.pattern_brush = None
+        self.pattern_key = None
+
     def set_font_family(self, family_name):
         self.font_family = family_name
 
-    def set_image(self, pixmap: QPixmap):
+    def set_font_path(self, font_path):
+        self.font_path = font_path
+
+    def is_tiled(self):
+        return self.position_text == TILED_POSITION
+
+    def is_image_watermark(self):
+        return self.logo_params[0] == IMAGE_WATERMARK
+
+    def preview_settings(self):
+        """由预览参数构造渲染引擎的设置（用于图片水印与平铺图案）"""
+        spacing, angle, stagger = self.tile_params
+        watermark_type, logo_path, logo_scale = self.logo_params
+        return WatermarkSettings(text=self.text, font_size=self.font_size, opacity=self.opacity,
+                                 color=QColor(self.color).getRgb()[:3], position=self.position_text,
+                                 font_path=self.font_path, watermark_type=watermark_type, logo_path=logo_path,
+                                 logo_scale=logo_scale, tile_spacing=spacing, tile_angle=angle % 360,
+                                 tile_stagger=stagger)
+
+    def set_image(self, pixmap: QPixmap, image_size=None):
+        """
+        pixmap 可以是缩小后的预览代理图；image_size 为原图尺寸 (w, h)，
+        水印字号和手动坐标都按原图像素换算。省略时使用 pixmap 自身尺寸。
+        """
         if pixmap is None or pixmap.isNull():
             self.base_pixmap = None
             self.display_pixmap = None
             self.img_width = 0
             self.img_height = 0
+            self.sprite_rect = QRect()
             self.update()
             return
+        if self.base_pixmap is not None and pixmap.cacheKey() == self.base_pixmap.cacheKey():
+            return  # 同一张图，无需重新缩放
         self.base_pixmap = pixmap
-        self.img_width = pixmap.width()
-        self.img_height = pixmap.height()
+        if image_size is None:
+            image_size = (pixmap.width(), pixmap.height())
+        self.img_width, self.img_height = image_size
         self.update_display_pixmap()
+        self.sprite_rect = QRect()  # 缩放比例变化，绘制前重新排版
         self.update()
 
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # 只有控件尺寸变化时才重新缩放底图
+        self.update_display_pixmap()
+        self.sprite_rect = QRect()
+
     def update_display_pixmap(self):
         if not self.base_pixmap:
             self.display_pixmap = None
@@ -116,9 +149,11 @@ class WatermarkPreviewLabel(QLabel):
         if w <= 0 or h <= 0:
             self.display_pixmap = self.base_pixmap
             return
-        self.display_pixmap = self.base_pixmap.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        with profiling.stage("preview_scale"):
+            self.display_pixmap = self.base_pixmap.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
 
-    def update_preview_params(self, text=None, font_size=None, color=None, opacity=None, position_text=None):
+    def update_preview_params(self, text=None, font_size=None, color=None, opacity=None, position_text=None,
+                              tile_params=None, logo_params=None):
         if text is not None:
             self.text = text if text.strip() else "Watermark"
         if font_size is not None:
@@ -129,92 +164,178 @@ class WatermarkPreviewLabel(QLabel):
             self.opacity = int(opacity)
         if position_text is not None:
             self.position_text = position_text
-        self.update_display_pixmap()
-        self.update()
-
-    def paintEvent(self, event):
-        super().paintEvent(event)
-        painter = QPainter(self)
-        painter.setRenderHints(QPainter.Antialiasing | QPainter.TextAntialiasing | QPainter.SmoothPixmapTransform)
-
-        if not self.display_pixmap:
-            painter.drawText(self.rect(), Qt.AlignCenter, "请选择一张图片")
-            painter.end()
-            return
-
+        if tile_params is not None:
+            self.tile_params = tuple(tile_params)
+        if logo_params is not None:
+            self.logo_params = tuple(logo_params)
+        # 只改水印参数时底图不变，只重绘水印新旧位置
+        self.relayout_text()
+
+    def image_geometry(self):
+        """底图在控件中的位置与缩放：(x, y, 显示宽, 显示高, 原图像素 -> 显示像素的比例)"""
         dp = self.display_pixmap
         dw = dp.width()
         dh = dp.height()
         x = (self.width() - dw) // 2
         y = (self.height() - dh) // 2
-
-        painter.drawPixmap(x, y, dp)
-
-        # scale: 原始 image pixels -> display pixels 的缩放比例 （统一用 x 方向）
         scale = (dw / self.img_width) if (self.img_width and dw) else 1.0
+        return x, y, dw, dh, scale
 
-        # 设定 QFont 的像素大小为 原始像素大小 * scale -> 这样预览字体和导出字体按比例一致
+    def ensure_text_sprite(self, scale):
+        """
+        预先把水印文字画到透明 QPixmap 上，只在文字、字号、字体、颜色、不透明度或缩放变化时重建。
+        QFont 像素大小为 原始像素大小 * scale，预览与导出字体按比例一致。
+        """
         display_font_px = max(1, int(self.font_size * scale))
+        dpr = self.devicePixelRatioF()
+        key = (self.text, display_font_px, self.font_family, QColor(self.color).rgb(), self.opacity, dpr)
+        if key == self.sprite_key:
+            return
+        self.sprite_key = key
 
         qfont = QFont()
         if self.font_family:
             qfont.setFamily(self.font_family)
         qfont.setPixelSize(display_font_px)
-        painter.setFont(qfont)
         fm = QFontMetrics(qfont)
-        text = self.text
-        text_w = fm.horizontalAdvance(text)
+        text_w = fm.horizontalAdvance(self.text)
         text_h = fm.height()
+        # 排版框（用于定位与点击检测）与墨迹范围取并集，避免斜体、悬垂字形被裁掉
+        layout_rect = QRect(0, 0, text_w, text_h)
+        ink_rect = fm.boundingRect(self.text).translated(0, fm.ascent())
+        bounds = layout_rect.united(ink_rect).adjusted(-1, -1, 1, 1)
+
+        sprite = QPixmap(bounds.size() * dpr)
+        sprite.setDevicePixelRatio(dpr)
+        sprite.fill(Qt.transparent)
+        color = QColor(self.color)
+        color.setAlpha(max(0, min(255, int(255 * (self.opacity / 100.0)))))
+        sp = QPainter(sprite)
+        sp.setRenderHints(QPainter.Antialiasing | QPainter.TextAntialiasing)
+        sp.setFont(qfont)
+        sp.setPen(color)
+        sp.drawText(-bounds.left(), -bounds.top() + fm.ascent(), self.text)
+        sp.end()
+
+        self.text_sprite = sprite
+        self.text_size = (text_w, text_h)
+        self.sprite_offset = bounds.topLeft()
+
+    def ensure_logo_sprite(self, display_size):
+        """
+        图片水印：向渲染引擎取按显示尺寸缩放好的水印图片（原图只解码一次，各尺寸按 LRU 缓存），
+        转成 QPixmap 后作为 sprite，只在图片、比例、不透明度或显示尺寸变化时重建。
+        """
+        dpr = self.devicePixelRatioF()
+        key = (self.logo_params, self.opacity, display_size, dpr)
+        if key == self.sprite_key:
+            return
+        self.sprite_key = key
+        device_size = (max(1, round(display_size[0] * dpr)), max(1, round(display_size[1] * dpr)))
+        try:
+            tile, _, (w, h) = get_logo_tile(self.preview_settings(), device_size)
+        except (OSError, ValueError):
+            # 未选择或无法读取水印图片时不绘制
+            self.text_sprite = QPixmap()
+            self.text_size = (0, 0)
+            self.sprite_offset = QPoint(0, 0)
+            return
+        data = tile.tobytes()  # QImage 不复制数据，转换完成前须保持引用
+        sprite = QPixmap.fromImage(QImage(data, w, h, w * 4, QImage.Format_RGBA8888))
+        sprite.setDevicePixelRatio(dpr)
+        self.text_sprite = sprite
+        self.text_size = (round(w / dpr), round(h / dpr))
+        self.sprite_offset = QPoint(0, 0)
+
+    def ensure_pattern_brush(self, scale):
+        """
+        平铺模式：取渲染引擎缓存的图案单元（与导出使用同一个），缩放到显示比例做成纹理画刷。
+        只在水印参数或缩放变化时重建；缩放后的整数尺寸误差由画刷变换补偿，平铺周期与导出一致。
+        """
+        rgb = QColor(self.color).getRgb()[:3]
+        image_size = (self.img_width, self.img_height)
+        key = (self.text, self.font_size, self.font_path, rgb, self.opacity, self.tile_params, self.logo_params,
+               image_size, scale)
+        if key == self.pattern_key:
+            return
+        self.pattern_key = key
 
-        margin = 10
-        pos_name = self.position_text
-
-        if pos_name == "手动" and self.custom_pos is not None:
-            cx_img, cy_img = self.custom_pos
-            disp_cx = int(cx_img * scale) + x
-            disp_cy = int(cy_img * scale) + y
-            tx = disp_cx - text_w // 2
-            ty = disp_cy - text_h // 2
+        try:
+            cell = get_pattern_cell(self.preview_settings(), image_size)
+        except (OSError, ValueError):
+            self.pattern_brush = None
+            return
+        data = cell.tobytes()  # QImage 不复制数据，缩放完成前须保持引用
+        qimage = QImage(data, cell.width, cell.height, cell.width * 4, QImage.Format_RGBA8888)
+        target_w = max(1, round(cell.width * scale))
+        target_h = max(1, round(cell.height * scale))
+        pixmap = QPixmap.fromImage(qimage.scaled(target_w, target_h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+        brush = QBrush(pixmap)
+        brush.setTransform(QTransform.fromScale(cell.width * scale / target_w, cell.height * scale / target_h))
+        self.pattern_brush = brush
+
+    def layout_text(self):
+        """计算文字在控件中的位置，更新 last_text_rect（点击检测）与 sprite_rect（重绘区域）"""
+        if not self.display_pixmap:
+            self.last_text_rect = None
+            self.sprite_rect = QRect()
+            return
+        x, y, dw, dh, scale = self.image_geometry()
+        if self.is_tiled():
+            # 平铺图案覆盖整幅底图，不支持拖拽
+            self.ensure_pattern_brush(scale)
+            self.last_text_rect = None
+            self.sprite_rect = QRect(x, y, dw, dh)
+            return
+        if self.is_image_watermark():
+            self.ensure_logo_sprite((dw, dh))
         else:
-            if pos_name == "左上角":
-                tx = x + margin
-                ty = y + margin
-            elif pos_name == "上中":
-                tx = x + (dw - text_w) // 2
-                ty = y + margin
-            elif pos_name == "右上角":
-                tx = x + dw - text_w - margin
-                ty = y + margin
-            elif pos_name == "左中":
-                tx = x + margin
-                ty = y + (dh - text_h) // 2
-            elif pos_name == "居中":
-                tx = x + (dw - text_w) // 2
-                ty = y + (dh - text_h) // 2
-            elif pos_name == "右中":
-                tx = x + dw - text_w - margin
-                ty = y + (dh - text_h) // 2
-            elif pos_name == "左下角":
-                tx = x + margin
-                ty = y + dh - text_h - margin
-            elif pos_name == "下中":
-                tx = x + (dw - text_w) // 2
-                ty = y + dh - text_h - margin
-            elif pos_name == "右下角":
-                tx = x + dw - text_w - margin
-                ty = y + dh - text_h - margin
-            else:
-                tx = x + dw - text_w - margin
-                ty = y + dh - text_h - margin
+            self.ensure_text_sprite(scale)
+        text_w, text_h = self.text_size
+        custom_pos = None
+        if self.custom_pos is not None:
+            custom_pos = (self.custom_pos[0] * scale, self.custom_pos[1] * scale)
+        tx, ty = compute_position((dw, dh), self.text_size, self.position_text, custom_pos)
+        self.last_text_rect = QRect(x + tx, y + ty, text_w, text_h)
+        self.sprite_rect = QRect(self.last_text_rect.topLeft() + self.sprite_offset,
+                                 self.text_sprite.size() / self.text_sprite.devicePixelRatio())
+
+    def relayout_text(self):
+        """水印变化时只重绘旧位置与新位置，不重绘整幅底图"""
+        old_rect = QRect(self.sprite_rect)
+        self.layout_text()
+        if old_rect.isValid():
+            self.update(old_rect)
+        if self.sprite_rect.isValid():
+            self.update(self.sprite_rect)
+        if not self.display_pixmap:
+            self.update()
 
-        self.last_text_rect = QRect(tx, ty, text_w, text_h)
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        painter = QPainter(self)
+        painter.setRenderHints(QPainter.Antialiasing | QPainter.TextAntialiasing | QPainter.SmoothPixmapTransform)
 
-        color = QColor(self.color)
-        alpha = max(0, min(255, int(255 * (self.opacity / 100.0))))
-        color.setAlpha(alpha)
-        painter.setPen(color)
+        if not self.display_pixmap:
+            painter.drawText(self.rect(), Qt.AlignCenter, "请选择一张图片")
+            painter.end()
+            return
 
-        painter.drawText(tx, ty + fm.ascent(), text)
+        # 只绘制需要重绘的那部分底图
+        x, y, dw, dh, _ = self.image_geometry()
+        dirty = event.rect().intersected(QRect(x, y, dw, dh))
+        if not dirty.isEmpty():
+            painter.drawPixmap(dirty, self.display_pixmap, dirty.translated(-x, -y))
+
+        if not self.sprite_rect.isValid():
+            self.layout_text()
+        if self.is_tiled():
+            if not dirty.isEmpty() and self.pattern_brush is not None:
+                # 图案原点与底图左上角对齐，与导出时一致
+                painter.setBrushOrigin(x, y)
+                painter.fillRect(dirty, self.pattern_brush)
+        elif self.sprite_rect.intersects(event.rect()):
+            painter.drawPixmap(self.sprite_rect.topLeft(), self.text_sprite)
         painter.end()
 
     def mousePressEvent(self, event):
@@ -239,13 +360,7 @@ class WatermarkPreviewLabel(QLabel):
             center_disp_x = pt.x() - self.drag_offset.x()
             center_disp_y = pt.y() - self.drag_offset.y()
 
-            dp = self.display_pixmap
-            dw = dp.width()
-            dh = dp.height()
-            img_x = (self.width() - dw) // 2
-            img_y = (self.height() - dh) // 2
-            scale = (dw / self.img_width) if (self.img_width and dw) else 1.0
-
+            img_x, img_y, _, _, scale = self.image_geometry()
             cx_img = (center_disp_x - img_x) / scale
             cy_img = (center_disp_y - img_y) / scale
 
@@ -255,7 +370,7 @@ class WatermarkPreviewLabel(QLabel):
             self.custom_pos = (cx_img, cy_img)
             # 拖拽过程中也发信号（主窗口会切换到手动）
             self.customPosChanged.emit()
-            self.update()
+            self.relayout_text()
             event.accept()
         else:
             super().mouseMoveEvent(event)
@@ -271,11 +386,301 @@ class WatermarkPreviewLabel(QLabel):
 
     def clear_custom_pos(self):
         self.custom_pos = None
-        self.update()
+        self.relayout_text()
 
     def get_custom_pos_image_coords(self):
         return self.custom_pos
 
+# ----------------------
+# 后台导出线程：驱动进程池，逐张回报结果，避免阻塞 GUI
+# ----------------------
+class ExportWorker(QThread):
+    exportPlanned = pyqtSignal(int, int)
+    resultReady = pyqtSignal(dict)
+    exportFinished = pyqtSignal(int, int, int)
+
+    def __init__(self, jobs, workers, output_folder, incremental=True, max_memory_mb=None, parent=None):
+        super().__init__(parent)
+        self.jobs = jobs  # 为 None 时继续输出文件夹中未完成的任务
+        self.workers = workers
+        self.max_memory_mb = max_memory_mb
+        self.output_folder = output_folder
+        self.incremental = incremental
+        self.cancel_event = threading.Event()
+        self.error = None  # 导出中途中断时的错误信息
+
+    def cancel(self):
+        """不再开始新的图片；处理中的图片完成后线程结束，任务文件保留以便继续"""
+        self.cancel_event.set()
+
+    def run(self):
+        counts = [0, 0]  # 已完成的成功/失败数，导出中断时用于汇总
+
+        def on_result(result):
+            counts[0 if result["ok"] else 1] += 1
+            self.resultReady.emit(result)
+
+        run = partial(run_export, workers=self.workers, cancel_event=self.cancel_event,
+                      max_memory_mb=self.max_memory_mb)
+        outcome = None
+        try:
+            if self.jobs is None:
+                outcome = resume_export(self.output_folder, run, on_result=on_result,
+                                        on_plan=self.exportPlanned.emit) or (0, 0, 0)
+            else:
+                # 增量导出：根据输出文件夹中的清单跳过源图与设置都未变化的图片
+                outcome = run_incremental_export(
+                    self.jobs, self.output_folder, run, on_result=on_result,
+                    force=not self.incremental, on_plan=self.exportPlanned.emit)
+        except Exception as e:
+            # 如输出文件夹不可写、进程池异常等；无论如何都要发出结束信号，否则界面一直停在导出中
+            self.error = str(e) or type(e).__name__
+        finally:
+            profiling.finish_batch()  # 开启性能统计时写出报告
+            self.exportFinished.emit(*(outcome or (counts[0], counts[1], 0)))
+
+# ----------------------
+# 后台扫描文件夹：按块把找到的图片交回 GUI 线程，大目录树也不会卡住界面
+# ----------------------
+class FolderScanWorker(QThread):
+    filesFound = pyqtSignal(list)
+    scanFinished = pyqtSignal(int)
+
+    def __init__(self, folder_path, recursive=False, include=None, exclude=None, parent=None):
+        super().__init__(parent)
+        self.folder_path = folder_path
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.stop_event = threading.Event()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def run(self):
+        found = 0
+        for chunk in scan_images(self.folder_path, recursive=self.recursive, include=self.include,
+                                 exclude=self.exclude, should_stop=self.stop_event.is_set):
+            found += len(chunk)
+            self.filesFound.emit(chunk)
+        self.scanFinished.emit(found)
+
+# ----------------------
+# 导出进度对话框：完成数、速度、剩余时间、失败列表与取消按钮
+# ----------------------
+class ExportProgressDialog(QDialog):
+    cancelRequested = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("导出进度")
+        self.setMinimumWidth(460)
+        self.progress = ExportProgress()
+        self.skipped_count = 0
+        self.finished_export = False
+
+        layout = QVBoxLayout(self)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 0)  # 规划阶段显示为忙碌
+        layout.addWidget(self.progress_bar)
+        self.count_label = QLabel("正在准备...")
+        layout.addWidget(self.count_label)
+        self.speed_label = QLabel("")
+        layout.addWidget(self.speed_label)
+        self.error_list = QListWidget()
+        self.error_list.setVisible(False)
+        layout.addWidget(self.error_list)
+        self.cancel_btn = QPushButton("取消")
+        self.cancel_btn.clicked.connect(self.on_cancel_clicked)
+        layout.addWidget(self.cancel_btn)
+
+        # 速度与剩余时间按固定频率刷新，避免每张图都重排界面
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(500)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start()
+
+    def set_plan(self, pending_count, skipped_count):
+        self.progress = ExportProgress(pending_count)
+        self.skipped_count = skipped_count
+        self.progress_bar.setRange(0, max(1, pending_count))
+        self.refresh()
+
+    def add_result(self, result):
+        self.progress.update(result)
+        if not result["ok"]:
+            self.error_list.setVisible(True)
+            self.error_list.addItem(f"{os.path.basename(result['image_path'])}: {result['error']}")
+
+    def refresh(self):
+        p = self.progress
+        if p.total:
+            self.progress_bar.setValue(p.done)
+        text = f"已完成 {p.done}/{p.total} 张，失败 {p.failed} 张"
+        if self.skipped_count:
+            text += f"，未变化跳过 {self.skipped_count} 张"
+        self.count_label.setText(text)
+        eta = "" if self.finished_export else f"，剩余 {ExportProgress.format_seconds(p.eta_seconds)}"
+        self.speed_label.setText(f"{p.images_per_second:.1f} 张/秒，{p.mb_per_second:.1f} MB/s，"
+                                 f"用时 {ExportProgress.format_seconds(p.elapsed)}{eta}")
+
+    def on_cancel_clicked(self):
+        if self.finished_export:
+            self.accept()
+            return
+        self.cancel_btn.setEnabled(False)
+        self.cancel_btn.setText("正在取消（等待处理中的图片完成）...")
+        self.cancelRequested.emit()
+
+    def finish(self, cancelled, error=None):
+        self.finished_export = True
+        self.refresh_timer.stop()
+        self.refresh()
+        if error:
+            self.error_list.setVisible(True)
+            self.error_list.addItem(f"导出中断: {error}")
+            self.setWindowTitle("导出中断")
+        else:
+            self.setWindowTitle("导出已取消" if cancelled else "导出完成")
+        self.cancel_btn.setEnabled(True)
+        self.cancel_btn.setText("关闭")
+
+    def closeEvent(self, event):
+        # 导出进行中关闭窗口视为取消
+        if not self.finished_export:
+            self.on_cancel_clicked()
+        super().closeEvent(event)
+
+# ----------------------
+# 后台缩略图任务：在线程池中解码，生成 QImage 后通过信号交回 GUI 线程
+# （QPixmap 只能在 GUI 线程创建，这里只产出 QImage）
+# ----------------------
+class ThumbnailSignals(QObject):
+    thumbnailReady = pyqtSignal(str, QImage)
+
+
+class ThumbnailTask(QRunnable):
+    def __init__(self, file_path, signals, cache=None):
+        super().__init__()
+        self.file_path = file_path
+        self.signals = signals
+        self.cache = cache
+
+    def run(self):
+        try:
+            thumb = load_thumbnail(self.file_path, self.cache)
+            data = thumb.tobytes("raw", "RGBA")
+            qimage = QImage(data, thumb.width, thumb.height, thumb.width * 4, QImage.Format_RGBA8888).copy()
+        except Exception:
+            qimage = QImage()
+        self.signals.thumbnailReady.emit(self.file_path, qimage)
+
+# ----------------------
+# 图片列表模型
+# 路径按顺序存放在 list 中，另有 path -> 行号 的 dict，判重与查找都是 O(1)；
+# 批量插入/删除各只发一次（或每个连续区间一次）行变化通知。
+# 缩略图按需加载：视图只为可见的行请求 DecorationRole，首次请求时发出 iconRequested，
+# 解码完成后由 set_icon 填入。图标按 LRU 保留 ICON_CACHE_SIZE 个，被淘汰的行再次可见时重新加载。
+# ----------------------
+ICON_CACHE_SIZE = 1000
+
+
+class ImageListModel(QAbstractListModel):
+    iconRequested = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.paths = []
+        self.rows = {}  # path -> row
+        self.icons = OrderedDict()  # path -> QIcon（LRU）
+        self.requested = set()  # 已请求、尚未完成的缩略图
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.rows
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.paths):
+            return None
+        path = self.paths[index.row()]
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == Qt.DecorationRole:
+            icon = self.icons.get(path)
+            if icon is not None:
+                self.icons.move_to_end(path)
+                return icon
+            if path not in self.requested:
+                self.requested.add(path)
+                self.iconRequested.emit(path)
+            return None
+        if role in (Qt.ToolTipRole, Qt.UserRole):
+            return path
+        return None
+
+    def path_at(self, row):
+        return self.paths[row] if 0 <= row < len(self.paths) else None
+
+    def add_paths(self, paths):
+        """在末尾批量加入不在列表中的路径，返回实际加入的数量"""
+        new_paths = []
+        seen = set()
+        for path in paths:
+            if path not in self.rows and path not in seen:
+                seen.add(path)
+                new_paths.append(path)
+        if not new_paths:
+            return 0
+        first = len(self.paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(new_paths) - 1)
+        for offset, path in enumerate(new_paths):
+            self.rows[path] = first + offset
+        self.paths.extend(new_paths)
+        self.endInsertRows()
+        return len(new_paths)
+
+    def remove_rows(self, rows):
+        """批量删除行，按连续区间从后往前删，行号不会错位；返回被删除的路径"""
+        rows = sorted({r for r in rows if 0 <= r < len(self.paths)}, reverse=True)
+        removed = []
+        i = 0
+        while i < len(rows):
+            last = rows[i]
+            first = last
+            while i + 1 < len(rows) and rows[i + 1] == first - 1:
+                i += 1
+                first = rows[i]
+            i += 1
+            self.beginRemoveRows(QModelIndex(), first, last)
+            removed.extend(self.paths[first:last + 1])
+            del self.paths[first:last + 1]
+            self.endRemoveRows()
+        for path in removed:
+            self.icons.pop(path, None)
+            self.requested.discard(path)
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        return removed
+
+    def set_icon(self, path, icon):
+        self.requested.discard(path)
+        row = self.rows.get(path)
+        if row is None:
+            return
+        self.icons[path] = icon
+        self.icons.move_to_end(path)
+        while len(self.icons) > ICON_CACHE_SIZE:
+            self.icons.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+# 预览代理图缓存的条目数（每条是不超过屏幕分辨率的 QPixmap）
+PREVIEW_CACHE_SIZE = 16
+
 # ----------------------
 # 主窗口
 # ----------------------
@@ -286,9 +691,25 @@ class PhotoWatermarkApp(QMainWindow):
         self.font_family = None  # 若成功在 Qt 中注册会填上
         # 确保模板目录存在
         os.makedirs(TEMPLATES_DIR, exist_ok=True)
+        # last used 设置由后台线程合并写入，拖拽/输入时不阻塞界面
+        self.last_used_writer = DebouncedJsonWriter(os.path.join(TEMPLATES_DIR, LAST_USED_FILENAME))
+        self.image_model = ImageListModel(self)
+        self.image_model.iconRequested.connect(self.request_thumbnail)
+        self.thumbnail_pool = QThreadPool(self)
+        try:
+            self.thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_PATH)
+        except Exception:
+            self.thumbnail_cache = None  # 缓存不可用时直接解码，不影响使用
+        self.thumbnail_signals = ThumbnailSignals(self)
+        self.thumbnail_signals.thumbnailReady.connect(self.on_thumbnail_ready)
         self.initUI()
 
-        self.image_paths = []
+        self.export_worker = None
+        self.scan_workers = []
+        # 从文件夹子目录导入的图片 -> 相对导入根目录的子目录，导出时在输出文件夹中镜像该结构
+        self.image_subfolders = {}
+        # 预览：key 为 (path, mtime) -> (代理 QPixmap, 原图尺寸)
+        self.preview_cache = OrderedDict()
         self.setAcceptDrops(True)
 
         # 程序启动时尝试加载 last used 设置
@@ -320,11 +741,31 @@ class PhotoWatermarkApp(QMainWindow):
         import_layout.addWidget(self.import_folder_btn)
         left_layout.addLayout(import_layout)
 
-        self.image_list = QListWidget()
-        self.image_list.setViewMode(QListWidget.IconMode)
-        self.image_list.setIconSize(QSize(128, 128))
-        self.image_list.setResizeMode(QListWidget.Adjust)
+        # 导入文件夹选项
+        scan_layout = QHBoxLayout()
+        self.recursive_import = QCheckBox("包含子文件夹")
+        scan_layout.addWidget(self.recursive_import)
+        self.include_patterns = QLineEdit()
+        self.include_patterns.setPlaceholderText("只导入，如 IMG_*;*.jpg")
+        scan_layout.addWidget(self.include_patterns)
+        self.exclude_patterns = QLineEdit()
+        self.exclude_patterns.setPlaceholderText("排除，如 */thumbs/*")
+        scan_layout.addWidget(self.exclude_patterns)
+        left_layout.addLayout(scan_layout)
+
+        self.image_list = QListView()
+        self.image_list.setModel(self.image_model)
+        self.image_list.setViewMode(QListView.IconMode)
+        self.image_list.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.image_list.setResizeMode(QListView.Adjust)
+        self.image_list.setMovement(QListView.Static)
         self.image_list.setSpacing(10)
+        self.image_list.setSelectionMode(QListView.ExtendedSelection)
+        # 所有项尺寸相同且分批布局，大量导入时不必每次重新测量全部项
+        self.image_list.setUniformItemSizes(True)
+        self.image_list.setLayoutMode(QListView.Batched)
+        # 统一的格子尺寸，未加载缩略图的项也占同样大小，滚动时布局不会跳动
+        self.image_list.setGridSize(QSize(THUMBNAIL_SIZE + 24, THUMBNAIL_SIZE + 36))
         left_layout.addWidget(self.image_list)
 
         self.remove_btn = QPushButton("移除选中图片")
@@ -344,6 +785,7 @@ class PhotoWatermarkApp(QMainWindow):
         preview_layout.addWidget(self.preview_label)
         right_layout.addWidget(preview_group)
 
+        self.preview_label.set_font_path(self.font_path)
         # 如果找到了字体路径，尝试在 Qt 中注册以保证预览与 Pillow 字体家族一致
         if self.font_path:
             try:
@@ -358,6 +800,11 @@ class PhotoWatermarkApp(QMainWindow):
 
         watermark_group = QGroupBox("水印设置")
         watermark_layout = QFormLayout(watermark_group)
+        self.watermark_type = QComboBox()
+        self.watermark_type.addItems(WATERMARK_TYPES)
+        self.watermark_type.currentIndexChanged.connect(self.on_watermark_type_changed)
+        watermark_layout.addRow("水印类型:", self.watermark_type)
+
         self.watermark_text = QLineEdit("Watermark")
         self.watermark_text.textChanged.connect(self.on_setting_changed)
         watermark_layout.addRow("水印文本:", self.watermark_text)
@@ -382,11 +829,53 @@ class PhotoWatermarkApp(QMainWindow):
         color_layout.addWidget(self.color_btn)
         watermark_layout.addRow("水印颜色:", color_layout)
 
+        # 图片水印（带透明通道的 PNG 等），宽度按目标图片宽度的百分比缩放
+        logo_layout = QHBoxLayout()
+        self.logo_path = QLineEdit()
+        self.logo_path.setPlaceholderText("带透明通道的 PNG 图片")
+        self.logo_path.editingFinished.connect(self.on_setting_changed)
+        logo_layout.addWidget(self.logo_path)
+        self.logo_browse_btn = QPushButton("选择...")
+        self.logo_browse_btn.clicked.connect(self.choose_logo)
+        logo_layout.addWidget(self.logo_browse_btn)
+        self.logo_scale = QSpinBox()
+        self.logo_scale.setRange(1, 100)
+        self.logo_scale.setValue(WatermarkSettings.logo_scale)
+        self.logo_scale.setPrefix("宽度 ")
+        self.logo_scale.setSuffix(" %")
+        self.logo_scale.valueChanged.connect(self.on_setting_changed)
+        logo_layout.addWidget(self.logo_scale)
+        watermark_layout.addRow("水印图片:", logo_layout)
+
         self.position = QComboBox()
-        self.position.addItems(["左上角", "上中", "右上角", "左中", "居中", "右中", "左下角", "下中", "右下角", "手动"])
+        self.position.addItems(POSITIONS)
         self.position.currentIndexChanged.connect(self.on_position_changed)
         watermark_layout.addRow("水印位置:", self.position)
 
+        # 平铺模式参数（位置选择“平铺”时生效）
+        tiled_layout = QHBoxLayout()
+        self.tile_spacing = QSpinBox()
+        self.tile_spacing.setRange(0, 5000)
+        self.tile_spacing.setValue(WatermarkSettings.tile_spacing)
+        self.tile_spacing.setPrefix("间距 ")
+        self.tile_spacing.setSuffix(" px")
+        self.tile_spacing.valueChanged.connect(self.on_setting_changed)
+        tiled_layout.addWidget(self.tile_spacing)
+        self.tile_angle = QSpinBox()
+        self.tile_angle.setRange(-180, 180)
+        self.tile_angle.setValue(WatermarkSettings.tile_angle)
+        self.tile_angle.setPrefix("角度 ")
+        self.tile_angle.setSuffix("°")
+        self.tile_angle.valueChanged.connect(self.on_setting_changed)
+        tiled_layout.addWidget(self.tile_angle)
+        self.tile_stagger = QCheckBox("错行")
+        self.tile_stagger.setChecked(WatermarkSettings.tile_stagger)
+        self.tile_stagger.toggled.connect(self.on_setting_changed)
+        tiled_layout.addWidget(self.tile_stagger)
+        watermark_layout.addRow("平铺:", tiled_layout)
+        self.update_tile_controls()
+        self.update_type_controls()
+
         # 模板管理行（放在水印设置中，尽量不改变原有位置结构）
         tpl_hbox = QHBoxLayout()
         self.template_combo = QComboBox()
@@ -414,9 +903,35 @@ class PhotoWatermarkApp(QMainWindow):
         output_layout.addRow("输出文件夹:", output_folder_layout)
 
         self.output_format = QComboBox()
-        self.output_format.addItems(["JPEG", "PNG"])
+        self.output_format.addItems(available_output_formats())
         output_layout.addRow("输出格式:", self.output_format)
 
+        # 编码参数（随模板保存）
+        self.encode_preset = QComboBox()
+        self.encode_preset.addItems(ENCODE_PRESETS)
+        self.encode_preset.setToolTip("快速：牺牲文件体积换取编码速度；最小体积：反之")
+        output_layout.addRow("编码预设:", self.encode_preset)
+
+        self.quality = QSpinBox()
+        self.quality.setRange(1, 100)
+        self.quality.setValue(75)
+        output_layout.addRow("质量 (JPEG/WEBP/AVIF):", self.quality)
+
+        jpeg_opts_layout = QHBoxLayout()
+        self.jpeg_subsampling = QComboBox()
+        self.jpeg_subsampling.addItems(JPEG_SUBSAMPLINGS)
+        jpeg_opts_layout.addWidget(self.jpeg_subsampling)
+        self.progressive = QCheckBox("渐进式")
+        jpeg_opts_layout.addWidget(self.progressive)
+        self.optimize = QCheckBox("优化")
+        jpeg_opts_layout.addWidget(self.optimize)
+        output_layout.addRow("JPEG 选项:", jpeg_opts_layout)
+
+        self.png_compress_level = QSpinBox()
+        self.png_compress_level.setRange(0, 9)
+        self.png_compress_level.setValue(6)
+        output_layout.addRow("PNG 压缩级别:", self.png_compress_level)
+
         self.naming_rule = QComboBox()
         self.naming_rule.addItems(["保留原文件名", "添加前缀", "添加后缀"])
         self.naming_rule.currentIndexChanged.connect(self.update_naming_options)
@@ -424,6 +939,24 @@ class PhotoWatermarkApp(QMainWindow):
 
         self.name_modifier = QLineEdit("wm_")
         output_layout.addRow("前缀/后缀:", self.name_modifier)
+
+        self.worker_count = QSpinBox()
+        self.worker_count.setRange(1, max(64, default_worker_count()))
+        self.worker_count.setValue(default_worker_count())
+        output_layout.addRow("并行进程数:", self.worker_count)
+
+        # 超过上限的图片（如超大全景图）记为失败，不会让整批导出因内存耗尽而中断
+        self.max_memory = QSpinBox()
+        self.max_memory.setRange(0, 1024 * 1024)
+        self.max_memory.setSingleStep(512)
+        self.max_memory.setSuffix(" MB")
+        self.max_memory.setSpecialValueText("不限制")
+        self.max_memory.setValue(DEFAULT_MAX_MEMORY_MB)
+        output_layout.addRow("单进程内存上限:", self.max_memory)
+
+        self.incremental_export = QCheckBox("跳过未变化的图片（增量导出）")
+        self.incremental_export.setChecked(True)
+        output_layout.addRow("", self.incremental_export)
         right_layout.addWidget(output_group)
 
         self.apply_btn = QPushButton("应用水印并导出")
@@ -436,7 +969,7 @@ class PhotoWatermarkApp(QMainWindow):
         main_layout.addWidget(splitter)
 
         # 信号连接
-        self.image_list.itemSelectionChanged.connect(self.update_preview_from_selection)
+        self.image_list.selectionModel().selectionChanged.connect(self.update_preview_from_selection)
         self.preview_label.customPosChanged.connect(self.on_preview_custom_pos_changed)
 
         self.show()
@@ -447,26 +980,51 @@ class PhotoWatermarkApp(QMainWindow):
             event.acceptProposedAction()
 
     def dropEvent(self, event):
+        files = []
         for url in event.mimeData().urls():
             file_path = url.toLocalFile()
             if os.path.isfile(file_path) and self.is_image_file(file_path):
-                self.add_image(file_path)
+                files.append(file_path)
             elif os.path.isdir(file_path):
                 self.import_images_from_folder(file_path)
+        self.add_images(files)
         event.acceptProposedAction()
 
     def is_image_file(self, file_path):
-        supported_formats = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif']
         ext = os.path.splitext(file_path)[1].lower()
-        return ext in supported_formats
+        return ext in SUPPORTED_EXTENSIONS
 
     def import_images_from_folder(self, folder_path):
-        image_extensions = ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tiff', '*.gif']
-        image_files = []
-        for ext in image_extensions:
-            image_files.extend(glob.glob(os.path.join(folder_path, ext)))
-        for image_file in sorted(image_files):
-            self.add_image(image_file)
+        """在后台线程中扫描文件夹，找到的图片分块加入列表"""
+        worker = FolderScanWorker(folder_path, self.recursive_import.isChecked(),
+                                  parse_patterns(self.include_patterns.text()),
+                                  parse_patterns(self.exclude_patterns.text()), self)
+        worker.filesFound.connect(partial(self.add_scanned_images, folder_path))
+        worker.scanFinished.connect(partial(self.on_scan_finished, worker))
+        self.scan_workers.append(worker)
+        self.statusBar().showMessage(f"正在扫描 {folder_path} ...")
+        worker.start()
+
+    def on_scan_finished(self, worker, _found_count):
+        if worker in self.scan_workers:
+            self.scan_workers.remove(worker)
+        worker.wait()
+        worker.deleteLater()
+        if not self.scan_workers:
+            self.statusBar().showMessage(f"导入完成：列表中共 {len(self.image_model)} 张图片")
+
+    def add_scanned_images(self, root, file_paths):
+        for path in file_paths:
+            subfolder = relative_subfolder(path, root)
+            if subfolder:
+                self.image_subfolders[path] = subfolder
+        self.add_images(file_paths)
+
+    def add_images(self, file_paths):
+        """批量加入图片（扫描线程每块调用一次），只触发一次列表更新"""
+        self.image_model.add_paths(file_paths)
+        if self.scan_workers:
+            self.statusBar().showMessage(f"正在导入：列表中 {len(self.image_model)} 张")
 
     def import_single_image(self):
         file_path, _ = QFileDialog.getOpenFileName(
@@ -481,8 +1039,7 @@ class PhotoWatermarkApp(QMainWindow):
             self, "选择多张图片", "",
             "图片文件 (*.jpg *.jpeg *.png *.bmp *.tiff *.gif);;所有文件 (*)"
         )
-        for file_path in file_paths:
-            self.add_image(file_path)
+        self.add_images(file_paths)
 
     def import_folder(self):
         folder_path = QFileDialog.getExistingDirectory(self, "选择文件夹")
@@ -490,37 +1047,60 @@ class PhotoWatermarkApp(QMainWindow):
             self.import_images_from_folder(folder_path)
 
     def add_image(self, file_path):
-        if file_path not in self.image_paths:
-            self.image_paths.append(file_path)
-            item = QListWidgetItem()
-            file_name = os.path.basename(file_path)
-            item.setText(file_name)
-            pixmap = QPixmap(file_path)
-            if not pixmap.isNull():
-                scaled_pixmap = pixmap.scaled(128, 128, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                item.setIcon(QIcon(scaled_pixmap))
-            self.image_list.addItem(item)
+        self.image_model.add_paths([file_path])
+
+    def selected_ranges(self):
+        """选中的行区间 [(first, last)]；直接读选区范围，大范围选择时不必逐项展开"""
+        return [(r.top(), r.bottom()) for r in self.image_list.selectionModel().selection()]
+
+    def selected_image_path(self):
+        """当前选中的第一张图片（按列表顺序）的路径，没有选中时返回 None"""
+        ranges = self.selected_ranges()
+        return self.image_model.path_at(min(first for first, _ in ranges)) if ranges else None
 
     def remove_selected(self):
-        for item in self.image_list.selectedItems():
-            index = self.image_list.row(item)
-            if 0 <= index < len(self.image_paths):
-                del self.image_paths[index]
-            self.image_list.takeItem(index)
-        if self.image_list.count() == 0:
+        rows = [row for first, last in self.selected_ranges() for row in range(first, last + 1)]
+        self.image_model.remove_rows(rows)
+        if len(self.image_model) == 0:
             self.preview_label.set_image(None)
             self.preview_label.update_preview_params(text="请选择一张图片")
 
+    # ---------- 缩略图 ----------
+    def request_thumbnail(self, file_path):
+        """模型在某行首次可见时请求缩略图，交给后台线程池解码"""
+        self.thumbnail_pool.start(ThumbnailTask(file_path, self.thumbnail_signals, self.thumbnail_cache))
+
+    def on_thumbnail_ready(self, file_path, qimage):
+        # 解码失败时保留“已请求”标记，不会反复重试
+        if not qimage.isNull():
+            self.image_model.set_icon(file_path, QIcon(QPixmap.fromImage(qimage)))
+
+    def closeEvent(self, event):
+        for worker in self.scan_workers:
+            worker.cancel()
+            worker.wait()
+        # 导出进行中关闭窗口：不再开始新的图片，等处理中的图片完成，任务文件保留以便下次继续
+        if self.export_worker is not None:
+            self.export_worker.cancel()
+            self.export_worker.wait()
+        # 等后台缩略图任务结束后再提交并关闭缓存
+        self.thumbnail_pool.clear()
+        self.thumbnail_pool.waitForDone()
+        if self.thumbnail_cache is not None:
+            self.thumbnail_cache.close()
+            self.thumbnail_cache = None
+        # 退出前把尚未写出的 last used 设置落盘
+        self.last_used_writer.close()
+        profiling.write_report()
+        super().closeEvent(event)
+
     # ---------- 预览与设置变更 ----------
-    def update_preview_from_selection(self):
-        selected_items = self.image_list.selectedItems()
-        if selected_items:
-            index = self.image_list.row(selected_items[0])
-            if 0 <= index < len(self.image_paths):
-                image_path = self.image_paths[index]
-                pixmap = QPixmap(image_path)
-                if not pixmap.isNull():
-                    self.preview_label.set_image(pixmap)
+    def update_preview_from_selection(self, *_):
+        image_path = self.selected_image_path()
+        if image_path is not None:
+            proxy = self.load_preview_proxy(image_path)
+            if proxy is not None:
+                self.preview_label.set_image(*proxy)
         else:
             self.preview_label.set_image(None)
 
@@ -529,24 +1109,96 @@ class PhotoWatermarkApp(QMainWindow):
             font_size=self.font_size.value(),
             color=self.watermark_color,
             opacity=self.opacity.value(),
-            position_text=self.position.currentText()
+            position_text=self.position.currentText(),
+            tile_params=self.current_tile_params(),
+            logo_params=self.current_logo_params()
         )
 
         # 在切换图片或更新预览时，保存 last used 设置
         self.save_last_used_template()
 
+    def preview_proxy_limit(self):
+        """预览代理图的最长边：屏幕分辨率（考虑高分屏缩放）"""
+        screen = QApplication.primaryScreen()
+        if screen is None:
+            return 2048
+        size = screen.size()
+        return int(max(size.width(), size.height()) * screen.devicePixelRatio())
+
+    def load_preview_proxy(self, image_path):
+        """
+        返回 (代理 QPixmap, 原图尺寸)，按 LRU 缓存。
+        大图用 QImageReader.setScaledSize 直接按屏幕分辨率解码（JPEG 可缩小解码）。
+        """
+        try:
+            key = (image_path, os.stat(image_path).st_mtime_ns)
+        except OSError:
+            return None
+        cached = self.preview_cache.get(key)
+        if cached is not None:
+            self.preview_cache.move_to_end(key)
+            return cached
+
+        reader = QImageReader(image_path)
+        orig_size = reader.size()
+        limit = self.preview_proxy_limit()
+        if orig_size.isValid() and max(orig_size.width(), orig_size.height()) > limit:
+            reader.setScaledSize(orig_size.scaled(limit, limit, Qt.KeepAspectRatio))
+        with profiling.stage("preview_decode"):
+            image = reader.read()
+        if image.isNull():
+            return None
+        if not orig_size.isValid():
+            orig_size = image.size()
+        cached = (QPixmap.fromImage(image), (orig_size.width(), orig_size.height()))
+        self.preview_cache[key] = cached
+        while len(self.preview_cache) > PREVIEW_CACHE_SIZE:
+            self.preview_cache.popitem(last=False)
+        return cached
+
     def on_setting_changed(self, *_):
+        # update_preview_from_selection 内部已保存 last_used
         self.update_preview_from_selection()
-        # 实时保存当前设置为 last_used
-        self.save_last_used_template()
+
+    def current_logo_params(self):
+        return self.watermark_type.currentText(), self.logo_path.text().strip() or None, self.logo_scale.value()
+
+    def update_type_controls(self):
+        is_image = self.watermark_type.currentText() == IMAGE_WATERMARK
+        for widget in (self.watermark_text, self.font_size, self.color_btn):
+            widget.setEnabled(not is_image)
+        for widget in (self.logo_path, self.logo_browse_btn, self.logo_scale):
+            widget.setEnabled(is_image)
+
+    def on_watermark_type_changed(self, index):
+        self.update_type_controls()
+        self.update_preview_from_selection()
+
+    def choose_logo(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "选择水印图片", os.path.dirname(self.logo_path.text()),
+                                                   "图片文件 (*.png *.webp *.gif *.tiff *.bmp *.jpg *.jpeg)")
+        if file_path:
+            self.logo_path.setText(file_path)
+            self.update_preview_from_selection()
+
+    def current_tile_params(self):
+        return self.tile_spacing.value(), self.tile_angle.value(), self.tile_stagger.isChecked()
+
+    def update_tile_controls(self):
+        tiled = self.position.currentText() == TILED_POSITION
+        for widget in (self.tile_spacing, self.tile_angle, self.tile_stagger):
+            widget.setEnabled(tiled)
 
     def on_position_changed(self, index):
+        self.update_tile_controls()
         self.preview_label.update_preview_params(
             text=self.watermark_text.text(),
             font_size=self.font_size.value(),
             color=self.watermark_color,
             opacity=self.opacity.value(),
-            position_text=self.position.currentText()
+            position_text=self.position.currentText(),
+            tile_params=self.current_tile_params(),
+            logo_params=self.current_logo_params()
         )
         # 保存 last used
         self.save_last_used_template()
@@ -563,7 +1215,9 @@ class PhotoWatermarkApp(QMainWindow):
             font_size=self.font_size.value(),
             color=self.watermark_color,
             opacity=self.opacity.value(),
-            position_text=self.position.currentText()
+            position_text=self.position.currentText(),
+            tile_params=self.current_tile_params(),
+            logo_params=self.current_logo_params()
         )
         # 拖拽后保存 last used（以保留 custom_pos）
         self.save_last_used_template()
@@ -597,8 +1251,7 @@ class PhotoWatermarkApp(QMainWindow):
 
     # ---------- 模板管理 ----------
     def template_file_path(self, name):
-        safe_name = f"{name}.json"
-        return os.path.join(TEMPLATES_DIR, safe_name)
+        return template_file_path(name)
 
     def refresh_template_list(self):
         """扫描 templates/ 并刷新下拉框（第一个项为 -- 无 -- ）"""
@@ -634,8 +1287,7 @@ class PhotoWatermarkApp(QMainWindow):
         tpl = self._collect_current_settings(include_custom_pos=True)
         # 写入文件（覆盖同名）
         try:
-            with open(self.template_file_path(name), "w", encoding="utf-8") as f:
-                json.dump(tpl, f, ensure_ascii=False, indent=2)
+            write_json_atomic(self.template_file_path(name), tpl)
             # 刷新下拉并选中该模板
             self.refresh_template_list()
             idx = self.template_combo.findText(name)
@@ -694,7 +1346,21 @@ class PhotoWatermarkApp(QMainWindow):
             "output_format": self.output_format.currentText(),
             "naming_rule": self.naming_rule.currentIndex(),
             "name_modifier": self.name_modifier.text(),
-            "output_folder": self.output_folder.text()
+            "output_folder": self.output_folder.text(),
+            "workers": self.worker_count.value(),
+            "max_memory_mb": self.max_memory.value(),
+            "encode_preset": self.encode_preset.currentText(),
+            "quality": self.quality.value(),
+            "jpeg_subsampling": self.jpeg_subsampling.currentText(),
+            "progressive": self.progressive.isChecked(),
+            "optimize": self.optimize.isChecked(),
+            "png_compress_level": self.png_compress_level.value(),
+            "watermark_type": self.watermark_type.currentText(),
+            "logo_path": self.logo_path.text().strip() or None,
+            "logo_scale": self.logo_scale.value(),
+            "tile_spacing": self.tile_spacing.value(),
+            "tile_angle": self.tile_angle.value(),
+            "tile_stagger": self.tile_stagger.isChecked()
         }
         if include_custom_pos:
             cp = self.preview_label.get_custom_pos_image_coords()
@@ -738,6 +1404,49 @@ class PhotoWatermarkApp(QMainWindow):
             ofolder = tpl.get("output_folder", None)
             if ofolder:
                 self.output_folder.setText(ofolder)
+            workers = tpl.get("workers", None)
+            if isinstance(workers, int) and workers > 0:
+                self.worker_count.setValue(workers)
+            max_memory_mb = tpl.get("max_memory_mb", None)
+            if isinstance(max_memory_mb, int) and max_memory_mb >= 0:
+                self.max_memory.setValue(max_memory_mb)
+            # 编码参数
+            preset = tpl.get("encode_preset", None)
+            if preset:
+                idx3 = self.encode_preset.findText(preset)
+                if idx3 >= 0:
+                    self.encode_preset.setCurrentIndex(idx3)
+            if "quality" in tpl:
+                self.quality.setValue(int(tpl["quality"]))
+            subsampling = tpl.get("jpeg_subsampling", None)
+            if subsampling:
+                idx4 = self.jpeg_subsampling.findText(subsampling)
+                if idx4 >= 0:
+                    self.jpeg_subsampling.setCurrentIndex(idx4)
+            if "progressive" in tpl:
+                self.progressive.setChecked(bool(tpl["progressive"]))
+            if "optimize" in tpl:
+                self.optimize.setChecked(bool(tpl["optimize"]))
+            if "png_compress_level" in tpl:
+                self.png_compress_level.setValue(int(tpl["png_compress_level"]))
+            # 图片水印
+            wm_type = tpl.get("watermark_type", None)
+            if wm_type:
+                idx5 = self.watermark_type.findText(wm_type)
+                if idx5 >= 0:
+                    self.watermark_type.setCurrentIndex(idx5)
+            if "logo_path" in tpl:
+                self.logo_path.setText(tpl["logo_path"] or "")
+            if "logo_scale" in tpl:
+                self.logo_scale.setValue(int(tpl["logo_scale"]))
+            # 平铺参数（模板中的角度为 0~359，界面显示为 -180~180）
+            if "tile_spacing" in tpl:
+                self.tile_spacing.setValue(int(tpl["tile_spacing"]))
+            if "tile_angle" in tpl:
+                angle = int(tpl["tile_angle"]) % 360
+                self.tile_angle.setValue(angle - 360 if angle > 180 else angle)
+            if "tile_stagger" in tpl:
+                self.tile_stagger.setChecked(bool(tpl["tile_stagger"]))
             # custom pos
             cp = tpl.get("custom_pos", None)
             if cp is not None and isinstance(cp, (list, tuple)) and len(cp) >= 2:
@@ -759,12 +1468,7 @@ class PhotoWatermarkApp(QMainWindow):
     # ---------- last used 存取 ----------
     def save_last_used_template(self):
         tpl = self._collect_current_settings(include_custom_pos=True)
-        last_used_path = os.path.join(TEMPLATES_DIR, LAST_USED_FILENAME)
-        try:
-            with open(last_used_path, "w", encoding="utf-8") as f:
-                json.dump(tpl, f, ensure_ascii=False, indent=2)
-        except Exception:
-            pass  # 不阻塞主流程
+        self.last_used_writer.schedule(tpl)
 
     def load_last_used_template_if_exists(self):
         last_used_path = os.path.join(TEMPLATES_DIR, LAST_USED_FILENAME)
@@ -779,7 +1483,23 @@ class PhotoWatermarkApp(QMainWindow):
 
     # ---------- 导出（Pillow） ----------
     def apply_watermark(self):
-        if not self.image_paths:
+        if self.export_worker is not None and self.export_worker.isRunning():
+            QMessageBox.information(self, "提示", "导出正在进行中")
+            return
+
+        # 输出文件夹中有上次中断的任务时，询问是否继续
+        output_folder = self.output_folder.text()
+        if output_folder and has_pending_job(output_folder):
+            reply = QMessageBox.question(
+                self, "继续导出", "输出文件夹中有上次未完成的导出任务，是否继续该任务？\n"
+                                  "（选择“否”将按当前列表和设置重新开始导出）",
+                QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            if reply == QMessageBox.Yes:
+                self.start_export_worker(None, output_folder)
+                return
+
+        image_paths = list(self.image_model.paths)
+        if not image_paths:
             QMessageBox.warning(self, "警告", "请先导入图片")
             return
 
@@ -788,141 +1508,86 @@ class PhotoWatermarkApp(QMainWindow):
             QMessageBox.warning(self, "警告", "请选择输出文件夹")
             return
 
-        # 检查是否尝试导出到原文件夹（阻止覆盖）
-        for image_path in self.image_paths:
-            image_folder = os.path.dirname(image_path)
-            if os.path.abspath(output_folder) == os.path.abspath(image_folder):
-                QMessageBox.warning(self, "警告", "不能导出到原图片所在文件夹，以防止覆盖原图")
-                return
-
-        os.makedirs(output_folder, exist_ok=True)
+        if self.watermark_type.currentText() == IMAGE_WATERMARK and not os.path.isfile(self.logo_path.text().strip()):
+            QMessageBox.warning(self, "警告", "请选择水印图片")
+            return
 
-        success_count = 0
-        error_count = 0
-        for image_path in self.image_paths:
-            try:
-                # 如果当前选中项并处在手动 mode -> 使用 preview 的 custom_pos（原图像像素）
-                custom_coords = None
-                selected_items = self.image_list.selectedItems()
-                if selected_items:
-                    sel_index = self.image_list.row(selected_items[0])
-                    if 0 <= sel_index < len(self.image_paths) and self.image_paths[sel_index] == image_path:
-                        if self.position.currentText() == "手动":
-                            custom_coords = self.preview_label.get_custom_pos_image_coords()
-                self.add_watermark_to_image(image_path, output_folder, custom_coords)
-                success_count += 1
-            except Exception as e:
-                print(f"处理图片 {image_path} 时出错: {e}")
-                error_count += 1
+        # 如果当前选中项并处在手动 mode -> 该图使用 preview 的 custom_pos（原图像像素）
+        selected_path = self.selected_image_path()
+
+        settings = self._current_watermark_settings()
+        selected_settings = settings
+        if self.position.currentText() == "手动":
+            selected_settings = settings.with_custom_pos(self.preview_label.get_custom_pos_image_coords())
+        jobs = []
+        for image_path in image_paths:
+            job_settings = selected_settings if image_path == selected_path else settings
+            jobs.append(make_job(image_path, job_settings, output_folder, self.image_subfolders.get(image_path, "")))
+
+        # 检查是否尝试导出到原文件夹（阻止覆盖），同一对文件夹只检查一次
+        folder_pairs = {(os.path.dirname(job["image_path"]), job["output_folder"]) for job in jobs}
+        if any(os.path.abspath(src) == os.path.abspath(dst) for src, dst in folder_pairs):
+            QMessageBox.warning(self, "警告", "不能导出到原图片所在文件夹，以防止覆盖原图")
+            return
 
-        QMessageBox.information(self, "完成", f"处理完成！\n成功: {success_count} 张\n失败: {error_count} 张")
+        os.makedirs(output_folder, exist_ok=True)
+        self.start_export_worker(jobs, output_folder)
+
+    def start_export_worker(self, jobs, output_folder):
+        """jobs 为 None 时继续 output_folder 中未完成的任务"""
+        self.export_done = 0
+        self.export_total = len(jobs) if jobs is not None else 0
+        self.apply_btn.setEnabled(False)
+        self.statusBar().showMessage(f"正在导出 0/{self.export_total} ...")
+        self.export_worker = ExportWorker(jobs, self.worker_count.value(), output_folder,
+                                          self.incremental_export.isChecked(), self.max_memory.value(), self)
+        self.progress_dialog = ExportProgressDialog(self)
+        self.progress_dialog.cancelRequested.connect(self.export_worker.cancel)
+        self.progress_dialog.show()
+        self.export_worker.exportPlanned.connect(self.on_export_planned)
+        self.export_worker.resultReady.connect(self.on_export_result)
+        self.export_worker.exportFinished.connect(self.on_export_finished)
+        self.export_worker.start()
+
+    def _current_watermark_settings(self, custom_coords=None):
+        """把当前 UI 设置转换为渲染引擎使用的 WatermarkSettings"""
+        settings = WatermarkSettings.from_template(self._collect_current_settings(), font_path=self.font_path)
+        return settings.with_custom_pos(custom_coords)
+
+    def on_export_planned(self, pending_count, skipped_count):
+        self.export_total = pending_count
+        self.progress_dialog.set_plan(pending_count, skipped_count)
+        self.statusBar().showMessage(f"正在导出 0/{self.export_total}（未变化跳过 {skipped_count} 张）...")
+
+    def on_export_result(self, result):
+        self.export_done += 1
+        self.progress_dialog.add_result(result)
+        name = os.path.basename(result["image_path"])
+        if result["ok"]:
+            self.statusBar().showMessage(f"正在导出 {self.export_done}/{self.export_total}：{name}")
+        else:
+            self.statusBar().showMessage(f"正在导出 {self.export_done}/{self.export_total}：{name} 失败")
+
+    def on_export_finished(self, success_count, error_count, skipped_count):
+        cancelled = self.export_worker.cancel_event.is_set()
+        error = self.export_worker.error
+        self.apply_btn.setEnabled(True)
+        self.export_worker = None
+        self.progress_dialog.finish(cancelled, error)
+        state = "导出中断" if error else ("导出已取消" if cancelled else "导出完成")
+        self.statusBar().showMessage(
+            f"{state}：成功 {success_count} 张，失败 {error_count} 张，未变化跳过 {skipped_count} 张")
 
     def add_watermark_to_image(self, image_path, output_folder, custom_coords=None):
-        with Image.open(image_path) as img:
-            orig_mode = img.mode
-            if img.mode not in ('RGBA', 'LA'):
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                else:
-                    img = img.convert('RGBA')
-
-            draw_layer = Image.new('RGBA', img.size, (255, 255, 255, 0))
-            draw = ImageDraw.Draw(draw_layer)
-
-            text = self.watermark_text.text() or "Watermark"
-            font_size = self.font_size.value()  # 这是“原图像上的像素大小”
-
-            # 优先使用找到的系统字体路径
-            pil_font = None
-            if self.font_path:
-                try:
-                    pil_font = ImageFont.truetype(self.font_path, font_size)
-                except Exception:
-                    pil_font = None
-            if pil_font is None:
-                try:
-                    pil_font = ImageFont.truetype("arial.ttf", font_size)
-                except Exception:
-                    pil_font = ImageFont.load_default()
-
-            # 文本尺寸（兼容旧/新 pillow）
-            try:
-                text_width, text_height = draw.textsize(text, font=pil_font)
-            except AttributeError:
-                bbox = draw.textbbox((0, 0), text, font=pil_font)
-                text_width = bbox[2] - bbox[0]
-                text_height = bbox[3] - bbox[1]
-
-            width, height = img.size
-            position = self.position.currentText()
-            margin = 10
-
-            if position == "手动" and custom_coords is not None:
-                cx_img, cy_img = custom_coords
-                x = int(cx_img - text_width / 2)
-                y = int(cy_img - text_height / 2)
-            else:
-                if position == "左上角":
-                    x, y = margin, margin
-                elif position == "上中":
-                    x = (width - text_width) // 2
-                    y = margin
-                elif position == "右上角":
-                    x = width - text_width - margin
-                    y = margin
-                elif position == "左中":
-                    x = margin
-                    y = (height - text_height) // 2
-                elif position == "居中":
-                    x = (width - text_width) // 2
-                    y = (height - text_height) // 2
-                elif position == "右中":
-                    x = width - text_width - margin
-                    y = (height - text_height) // 2
-                elif position == "左下角":
-                    x = margin
-                    y = height - text_height - margin
-                elif position == "下中":
-                    x = (width - text_width) // 2
-                    y = height - text_height - margin
-                elif position == "右下角":
-                    x = width - text_width - margin
-                    y = height - text_height - margin
-                else:
-                    x = width - text_width - margin
-                    y = height - text_height - margin
-
-            r, g, b, _ = self.watermark_color.getRgb()
-            opacity = self.opacity.value()
-            alpha = int(255 * opacity / 100)
-
-            draw.text((x, y), text, font=pil_font, fill=(r, g, b, alpha))
-
-            watermarked = Image.alpha_composite(img, draw_layer)
-            output_format = self.output_format.currentText().lower()
-            file_name = os.path.basename(image_path)
-            base_name, ext = os.path.splitext(file_name)
-
-            naming_rule = self.naming_rule.currentIndex()
-            if naming_rule == 1:
-                new_base_name = f"{self.name_modifier.text()}{base_name}"
-            elif naming_rule == 2:
-                new_base_name = f"{base_name}{self.name_modifier.text()}"
-            else:
-                new_base_name = base_name
-
-            output_file_name = f"{new_base_name}.{output_format}"
-            output_path = os.path.join(output_folder, output_file_name)
-
-            if output_format in ('jpeg', 'jpg'):
-                watermarked = watermarked.convert('RGB')
-
-            watermarked.save(output_path)
+        settings = self._current_watermark_settings(custom_coords)
+        return render_file(image_path, settings, output_folder)
 
 # ----------------------
 # 运行
 # ----------------------
 if __name__ == '__main__':
+    # 打包成 exe 后，多进程子进程需要它才能正常启动
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     ex = PhotoWatermarkApp()
     sys.exit(app.exec_())
@@ -0,0 +1,97 @@
+# numpy_compositor.py
+# ----------------------
+# 可选的 NumPy 合成器（未安装 NumPy 时 available() 返回 False）
+# 水印块的 alpha 预乘项每块只计算一次，之后在文字包围盒内用整数定点运算混合，
+# 结果与 Pillow 的 paste(mask=...) / alpha_composite 逐位一致。
+# Pillow 不提供可写的零拷贝数组视图（np.asarray 会复制一份），因此包围盒区域先裁出、混合后再贴回。
+# NumPy 在第一次调用 available() 时才导入：默认使用 Pillow 时进程启动不必为它付出时间与内存。
+# ----------------------
+import weakref
+
+from PIL import Image
+
+np = None
+_import_failed = False
+
+PRECISION_BITS = 7  # 与 Pillow AlphaComposite.c 相同
+
+# id(tile) -> {source box: 预乘后的数组}；Image 不可哈希，因此按 id 存放，tile 被回收时随之删除
+_prepared = {}
+
+
+def available():
+    """按需导入 NumPy，未安装时返回 False；使用本模块的其他函数前须先调用"""
+    global np, _import_failed
+    if np is None and not _import_failed:
+        try:
+            import numpy
+        except ImportError:
+            _import_failed = True
+        else:
+            np = numpy
+    return np is not None
+
+
+def _div255(a):
+    # 与 Pillow 相同的 (a + 128) / 255 整数近似
+    a = a + 128
+    return ((a >> 8) + a) >> 8
+
+
+def _shift_div255(a):
+    return ((a >> 8) + a) >> 8
+
+
+def _prepare(tile, source):
+    per_tile = _prepared.get(id(tile))
+    if per_tile is None:
+        per_tile = _prepared[id(tile)] = {}
+        weakref.finalize(tile, _prepared.pop, id(tile), None)
+    prepared = per_tile.get(source)
+    if prepared is None:
+        rgba = np.asarray(tile.crop(source), dtype=np.uint32)
+        alpha = rgba[..., 3:4]
+        prepared = {
+            # 不透明底图：out = DIV255(dst * (255 - a) + src * a)
+            "premul": rgba[..., :3] * alpha,
+            "inv_alpha": 255 - alpha,
+            # 带透明度的底图（alpha_composite）所需的源项
+            "src_rgb": rgba[..., :3],
+            "src_a": alpha,
+            "src_a_scaled": alpha * (255 * 255 << PRECISION_BITS),
+        }
+        per_tile[source] = prepared
+    return prepared
+
+
+def _blend_rgb(region, prepared):
+    """region: (h, w, 3) uint8"""
+    out = _div255(region.astype(np.uint32) * prepared["inv_alpha"] + prepared["premul"])
+    return out.astype(np.uint8)
+
+
+def _blend_rgba(region, prepared):
+    """region: (h, w, 4) uint8，与 Pillow alpha_composite 相同的定点公式"""
+    dst = region.astype(np.uint32)
+    src_a = prepared["src_a"]
+    dst_a = dst[..., 3:4]
+    outa255 = src_a * 255 + dst_a * (255 - src_a)
+    coef1 = prepared["src_a_scaled"] // np.maximum(outa255, 1)
+    coef2 = (255 << PRECISION_BITS) - coef1
+    rgb = _shift_div255(prepared["src_rgb"] * coef1 + dst[..., :3] * coef2 + (0x80 << PRECISION_BITS)) >> PRECISION_BITS
+    alpha = _shift_div255(outa255 + 0x80)
+    out = np.concatenate([rgb, alpha], axis=-1).astype(np.uint8)
+    # 源像素完全透明时保持原样
+    return np.where(src_a == 0, region, out)
+
+
+def _blend(region, mode, prepared):
+    return _blend_rgb(region, prepared) if mode == 'RGB' else _blend_rgba(region, prepared)
+
+
+def composite(image, tile, dest, source):
+    """把 tile 的 source 区域混合到 image（RGB 或 RGBA）的 dest 处，原地修改 image"""
+    prepared = _prepare(tile, source)
+    box = (dest[0], dest[1], dest[0] + source[2] - source[0], dest[1] + source[3] - source[1])
+    region = np.asarray(image.crop(box))
+    image.paste(Image.fromarray(_blend(region, image.mode, prepared), image.mode), box[:2])
@@ -0,0 +1,251 @@
+# profiling.py
+# ----------------------
+# 可选的分阶段耗时统计（默认关闭）
+# 通过环境变量或命令行参数开启：
+#   PHOTOWATERMARK_PROFILE=stats.json   各阶段耗时直方图写入该 JSON 文件（值为 1 时输出到标准错误）
+#   PHOTOWATERMARK_CPROFILE=DIR         每个批次结束时在 DIR 中生成合并后的 cProfile 结果
+# 关闭时 stage() 只做一次布尔判断并返回共享的空上下文，对导出速度没有可测量的影响。
+# 子进程中的统计随导出结果返回主进程合并（见 export_pool.run_export）。
+# ----------------------
+import os
+import sys
+import json
+import time
+import uuid
+import glob
+import pstats
+import cProfile
+import threading
+from contextlib import nullcontext
+
+PROFILE_ENV = "PHOTOWATERMARK_PROFILE"
+CPROFILE_ENV = "PHOTOWATERMARK_CPROFILE"
+# 直方图桶的上界（毫秒），最后一个桶收纳更慢的样本
+BUCKET_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+ENABLED = bool(os.environ.get(PROFILE_ENV))
+CPROFILE_DIR = os.environ.get(CPROFILE_ENV) or None
+
+_NULL_CONTEXT = nullcontext()
+_lock = threading.Lock()
+_histograms = {}
+
+
+def configure(profile=None, cprofile_dir=None):
+    """
+    开启统计。同时写入环境变量，使之后启动的导出子进程（包括 spawn 方式）继承同样的设置。
+    profile 为报告文件路径或 "1"；cprofile_dir 为 cProfile 输出目录。
+    """
+    global ENABLED, CPROFILE_DIR
+    if profile:
+        os.environ[PROFILE_ENV] = profile
+        ENABLED = True
+    if cprofile_dir:
+        os.makedirs(cprofile_dir, exist_ok=True)
+        os.environ[CPROFILE_ENV] = cprofile_dir
+        CPROFILE_DIR = cprofile_dir
+
+
+def _round_ms(ms):
+    return None if ms is None else round(ms, 3)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, ms):
+        i = 0
+        while i < len(BUCKET_BOUNDS_MS) and ms > BUCKET_BOUNDS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def merge(self, data):
+        for i, n in enumerate(data["buckets"]):
+            self.counts[i] += n
+        self.total += data["total_ms"]
+        for attr, pick in (("min", min), ("max", max)):
+            other = data[f"{attr}_ms"]
+            if other is not None:
+                mine = getattr(self, attr)
+                setattr(self, attr, other if mine is None else pick(mine, other))
+
+    def quantile(self, q):
+        """按桶估计分位数（返回所在桶的上界，限制在实际记录的最小值与最大值之间）"""
+        count = sum(self.counts)
+        if count == 0:
+            return None
+        target = q * count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n:
+                bound = BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else self.max
+                return max(self.min, min(bound, self.max))
+        return self.max
+
+    def to_dict(self):
+        count = sum(self.counts)
+        return {
+            "count": count,
+            "total_ms": round(self.total, 3),
+            "mean_ms": round(self.total / count, 3) if count else None,
+            "min_ms": None if self.min is None else round(self.min, 3),
+            "max_ms": None if self.max is None else round(self.max, 3),
+            "p50_ms": _round_ms(self.quantile(0.5)),
+            "p99_ms": _round_ms(self.quantile(0.99)),
+            "buckets": list(self.counts),
+        }
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage(name):
+    """with profiling.stage("save"): ... 统计代码块耗时；未开启时几乎没有开销"""
+    if not ENABLED:
+        return _NULL_CONTEXT
+    return _Stage(name)
+
+
+def record(name, seconds):
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = Histogram()
+        hist.add(seconds * 1000)
+
+
+def snapshot():
+    with _lock:
+        return {name: hist.to_dict() for name, hist in _histograms.items()}
+
+
+def drain():
+    """取出并清空本进程的统计（子进程把它附在导出结果中返回）"""
+    with _lock:
+        data = {name: hist.to_dict() for name, hist in _histograms.items()}
+        _histograms.clear()
+    return data
+
+
+def merge(data):
+    with _lock:
+        for name, hist_data in data.items():
+            hist = _histograms.get(name)
+            if hist is None:
+                hist = _histograms[name] = Histogram()
+            hist.merge(hist_data)
+
+
+def format_report(data):
+    lines = [f"{'阶段':<16}{'次数':>8}{'总计ms':>12}{'平均ms':>10}{'p50ms':>9}{'p99ms':>9}{'最大ms':>10}"]
+    for name, h in sorted(data.items(), key=lambda item: -item[1]["total_ms"]):
+        lines.append(f"{name:<16}{h['count']:>8}{h['total_ms']:>12.1f}{h['mean_ms']:>10.2f}"
+                     f"{h['p50_ms']:>9}{h['p99_ms']:>9}{h['max_ms']:>10.1f}")
+    return "\n".join(lines)
+
+
+def write_report():
+    """按 PHOTOWATERMARK_PROFILE 写出当前累计的统计；未开启时什么也不做"""
+    if not ENABLED:
+        return
+    data = snapshot()
+    target = os.environ.get(PROFILE_ENV, "1")
+    if target == "1":
+        print(format_report(data), file=sys.stderr)
+        return
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "pid": os.getpid(),
+        "bucket_bounds_ms": list(BUCKET_BOUNDS_MS),
+        "stages": data,
+    }
+    try:
+        with open(target, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    except OSError as e:
+        print(f"写入性能统计失败: {e}", file=sys.stderr)
+
+
+# ----------------------
+# cProfile：每个任务单独采样并写出分片文件，批次结束时合并成一个文件
+# Python 3.12 起 cProfile 基于 sys.monitoring：同一时间只能开启一个采样器，但它覆盖进程内所有线程；
+# 更早的版本每个采样器只覆盖开启它的线程。多线程导出因此用 cprofiled_threads() / cprofiled_thread()。
+# ----------------------
+_CPROFILE_COVERS_THREADS = sys.version_info >= (3, 12)
+
+class _CProfiled:
+    __slots__ = ("profile",)
+
+    def __enter__(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profile.disable()
+        self.profile.dump_stats(os.path.join(CPROFILE_DIR, f"part-{os.getpid()}-{uuid.uuid4().hex}.prof"))
+        return False
+
+
+def cprofiled():
+    """对一个导出任务做 cProfile 采样（未设置 CPROFILE_DIR 时为空上下文）"""
+    if CPROFILE_DIR is None:
+        return _NULL_CONTEXT
+    return _CProfiled()
+
+
+def cprofiled_threads():
+    """在启动工作线程的线程中包住整个多线程导出：3.12 起用一个采样器覆盖所有工作线程，否则为空上下文"""
+    if CPROFILE_DIR is None or not _CPROFILE_COVERS_THREADS:
+        return _NULL_CONTEXT
+    return _CProfiled()
+
+
+def cprofiled_thread():
+    """在每个工作线程中包住整个循环：3.12 之前逐线程采样，之后由 cprofiled_threads() 统一采样，这里为空上下文"""
+    if CPROFILE_DIR is None or _CPROFILE_COVERS_THREADS:
+        return _NULL_CONTEXT
+    return _CProfiled()
+
+
+def finish_batch():
+    """批次结束：写出统计报告，并把 cProfile 分片合并为 batch-<时间>.prof，返回其路径"""
+    write_report()
+    if CPROFILE_DIR is None:
+        return None
+    parts = glob.glob(os.path.join(CPROFILE_DIR, "part-*.prof"))
+    if not parts:
+        return None
+    stats = pstats.Stats(parts[0])
+    for part in parts[1:]:
+        stats.add(part)
+    out_path = os.path.join(CPROFILE_DIR, f"batch-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+    stats.dump_stats(out_path)
+    for part in parts:
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+    return out_path
@@ -0,0 +1,124 @@
+# template_store.py
+# ----------------------
+# 配置：模板目录与 last used 文件名
+# GUI 与命令行共用，不依赖 PyQt5
+# ----------------------
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+
+
+def get_templates_dir():
+    # 如果是打包后的 exe，sys._MEIPASS 或 sys.argv[0] 会指向 exe 所在目录
+    if getattr(sys, 'frozen', False):
+        # exe 文件所在目录
+        exe_dir = os.path.dirname(sys.executable)
+        return os.path.join(exe_dir, "templates")
+    else:
+        # 普通脚本模式
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+TEMPLATES_DIR = get_templates_dir()
+os.makedirs(TEMPLATES_DIR, exist_ok=True)
+
+LAST_USED_FILENAME = "last_used.json"
+
+# 缩略图缓存与 templates/ 目录放在一起
+THUMBNAIL_CACHE_PATH = os.path.join(os.path.dirname(TEMPLATES_DIR), "thumbnail_cache.sqlite3")
+
+
+def template_file_path(name):
+    safe_name = f"{name}.json"
+    return os.path.join(TEMPLATES_DIR, safe_name)
+
+
+def resolve_template_path(name_or_path):
+    """接受模板文件路径，或 templates/ 目录下的模板名称（不带 .json）"""
+    if os.path.isfile(name_or_path):
+        return name_or_path
+    path = template_file_path(name_or_path)
+    if os.path.isfile(path):
+        return path
+    raise FileNotFoundError(f"找不到模板: {name_or_path}")
+
+
+def load_template(name_or_path):
+    with open(resolve_template_path(name_or_path), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json_atomic(path, data):
+    """先写同目录下的临时文件再 os.replace，写到一半崩溃也不会留下损坏的 JSON"""
+    tmp_path = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex}.json")
+    try:
+        with open(tmp_path, "x", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# ----------------------
+# 合并写入的后台 JSON 保存器
+# 频繁调用 schedule() 只会保留最新的数据，后台线程至多每 interval 秒写一次文件，
+# 调用方（GUI 线程）不会因为磁盘或网络目录变慢而卡顿。退出时调用 close() 落盘。
+# ----------------------
+class DebouncedJsonWriter:
+    def __init__(self, path, interval=0.5):
+        self.path = path
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.pending = None
+        self.last_write = 0.0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="DebouncedJsonWriter", daemon=True)
+        self.thread.start()
+
+    def schedule(self, data):
+        with self.cond:
+            self.pending = data
+            self.cond.notify()
+
+    def _take_when_due(self):
+        """等到有待写数据且距上次写入已过 interval，返回数据；关闭时返回 None"""
+        with self.cond:
+            while True:
+                if self.pending is None:
+                    if self.closed:
+                        return None
+                    self.cond.wait()
+                    continue
+                remaining = self.last_write + self.interval - time.monotonic()
+                if remaining > 0 and not self.closed:
+                    self.cond.wait(remaining)
+                    continue
+                data, self.pending = self.pending, None
+                return data
+
+    def _run(self):
+        while True:
+            data = self._take_when_due()
+            if data is None:
+                return
+            try:
+                write_json_atomic(self.path, data)
+            except Exception:
+                pass  # 不阻塞主流程
+            with self.cond:
+                self.last_write = time.monotonic()
+                self.cond.notify_all()
+
+    def close(self):
+        """立即写出尚未保存的数据并停止后台线程"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
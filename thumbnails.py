@@ -0,0 +1,128 @@
+# thumbnails.py
+# ----------------------
+# 列表缩略图生成（不依赖 PyQt5，可在后台线程中调用）
+# JPEG 使用 draft() 让解码器直接按 1/2~1/8 缩小解码，避免解出整幅原图。
+# ----------------------
+import io
+import os
+import time
+import sqlite3
+import threading
+
+from PIL import Image
+
+import profiling
+
+THUMBNAIL_SIZE = 128
+
+
+def make_thumbnail(image_path, size=THUMBNAIL_SIZE):
+    """返回不超过 size x size、保持宽高比的 RGBA 缩略图；无法解码时抛出异常"""
+    with profiling.stage("thumbnail"), Image.open(image_path) as img:
+        # 只对 JPEG 生效，其他格式忽略；请求 2 倍尺寸，留给后面的高质量缩放
+        img.draft('RGB', (size * 2, size * 2))
+        img.thumbnail((size, size), Image.LANCZOS)
+        return img.convert('RGBA')
+
+
+# ----------------------
+# 持久化缩略图缓存（SQLite 单文件）
+# 以 (路径, 缩略图尺寸) 为主键，并记录源文件 mtime 与大小，源文件变化后自动失效。
+# 总体积超过上限时按最近访问时间（LRU）淘汰。可被多个缩略图线程共享。
+# ----------------------
+class ThumbnailCache:
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+    COMMIT_EVERY = 64  # 累积多少次写入后提交一次事务
+
+    def __init__(self, db_path, max_bytes=DEFAULT_MAX_BYTES):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS thumbs ("
+            " path TEXT NOT NULL, thumb_size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL, file_size INTEGER NOT NULL,"
+            " data BLOB NOT NULL, last_access REAL NOT NULL,"
+            " PRIMARY KEY (path, thumb_size))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS thumbs_last_access ON thumbs (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM thumbs").fetchone()[0]
+
+    def get(self, image_path, thumb_size, stat):
+        """命中且源文件未变化时返回编码后的缩略图字节，否则返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT mtime_ns, file_size, data FROM thumbs WHERE path = ? AND thumb_size = ?",
+                (image_path, thumb_size)).fetchone()
+            if row is None or row[0] != stat.st_mtime_ns or row[1] != stat.st_size:
+                return None
+            self.conn.execute("UPDATE thumbs SET last_access = ? WHERE path = ? AND thumb_size = ?",
+                              (time.time(), image_path, thumb_size))
+            self._mark_dirty()
+            return row[2]
+
+    def put(self, image_path, thumb_size, stat, data):
+        with self.lock:
+            old = self.conn.execute("SELECT LENGTH(data) FROM thumbs WHERE path = ? AND thumb_size = ?",
+                                    (image_path, thumb_size)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO thumbs (path, thumb_size, mtime_ns, file_size, data, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (image_path, thumb_size, stat.st_mtime_ns, stat.st_size, sqlite3.Binary(data), time.time()))
+            self.total_bytes += len(data) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self._mark_dirty()
+
+    def _evict(self):
+        # 一次淘汰到上限的 90%，避免每次写入都触发淘汰
+        target = int(self.max_bytes * 0.9)
+        rows = self.conn.execute("SELECT rowid, LENGTH(data) FROM thumbs ORDER BY last_access").fetchall()
+        doomed = []
+        for rowid, length in rows:
+            if self.total_bytes <= target:
+                break
+            doomed.append((rowid,))
+            self.total_bytes -= length
+        self.conn.executemany("DELETE FROM thumbs WHERE rowid = ?", doomed)
+
+    def _mark_dirty(self):
+        self.pending += 1
+        if self.pending >= self.COMMIT_EVERY:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+def encode_thumbnail(thumb):
+    """不透明的缩略图存 JPEG（体积小），带透明通道的存 PNG"""
+    buf = io.BytesIO()
+    if thumb.getextrema()[3][0] == 255:
+        thumb.convert('RGB').save(buf, format='JPEG', quality=85)
+    else:
+        thumb.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def load_thumbnail(image_path, cache=None, size=THUMBNAIL_SIZE):
+    """优先从持久化缓存读取缩略图，未命中则解码原图并写回缓存"""
+    if cache is None:
+        return make_thumbnail(image_path, size)
+    stat = os.stat(image_path)
+    data = cache.get(image_path, size, stat)
+    if data is not None:
+        try:
+            with profiling.stage("thumbnail_cached"), Image.open(io.BytesIO(data)) as cached:
+                return cached.convert('RGBA')
+        except Exception:
+            pass  # 缓存损坏时重新生成
+    thumb = make_thumbnail(image_path, size)
+    cache.put(image_path, size, stat, encode_thumbnail(thumb))
+    return thumb
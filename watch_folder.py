@@ -0,0 +1,437 @@
+# watch_folder.py
+# ----------------------
+# 监视文件夹（无界面常驻服务，不依赖 PyQt5）
+# 监视输入文件夹，新到达的图片写完（大小与修改时间稳定）后立即交给进程池按模板加水印。
+# Linux 上通过 ctypes 调用 inotify，事件到达即处理；其他平台或 inotify 不可用时退回定时轮询。
+# 输出文件夹中的增量清单（见 export_manifest）同时作为状态文件：
+# 已处理且未变化的图片在重启后不会重复处理，停机期间到达的图片在启动时补做。
+# 用法：python main.py watch --template foo --input DIR --output DIR
+# ----------------------
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import profiling
+from export_manifest import ExportManifest, remove_stale_temp_files, output_conflict_error
+from export_pool import default_worker_count, make_executor, make_job, export_one, failed_result
+from file_scanner import scan_images, is_image_candidate, relative_subfolder
+from watermark_engine import output_path_for
+
+DEFAULT_SETTLE_SECONDS = 0.5  # 大小与修改时间保持不变多久后认为文件已写完
+CLOSE_CONFIRM_SECONDS = 0.1  # 写入方关闭文件或文件整体移入后，只需在这段时间后再确认一次没有变化
+DEFAULT_POLL_INTERVAL = 1.0  # 轮询模式的扫描间隔（秒）
+IDLE_TIMEOUT = 1.0  # 空闲时最长等待多久检查一次退出请求
+MANIFEST_SAVE_INTERVAL = 60.0  # 空闲时把清单日志合并进清单的最短间隔（秒）
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# 不订阅 IN_MODIFY：写入过程中的大量事件没有用处，文件是否写完由稳定性检查判断
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+def inotify_available():
+    return _libc is not None
+
+
+class FileFilter:
+    """判断路径是否需要处理：位于某个输入根目录下、符合扩展名与包含/排除规则，且不在输出文件夹内"""
+
+    def __init__(self, roots, output_folder, recursive=False, include=None, exclude=None):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.output_abs = os.path.abspath(output_folder)
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+
+    def in_output(self, path):
+        path = os.path.abspath(path)
+        return path == self.output_abs or path.startswith(self.output_abs + os.sep)
+
+    def accept(self, path):
+        path = os.path.abspath(path)
+        if self.in_output(path):
+            return False
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                rel_path = os.path.relpath(path, root).replace(os.sep, "/")
+                if not self.recursive and "/" in rel_path:
+                    return False
+                return is_image_candidate(rel_path, include=self.include, exclude=self.exclude)
+        return False
+
+    def subfolder(self, path):
+        """path 相对所在输入根目录的子目录（输出时镜像该结构）"""
+        path = os.path.abspath(path)
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                return relative_subfolder(path, root)
+        return ""
+
+    def scan(self):
+        """列出输入文件夹中现有的图片（启动时补做停机期间到达的文件）"""
+        for root in self.roots:
+            for chunk in scan_images(root, recursive=self.recursive, include=self.include, exclude=self.exclude):
+                for path in chunk:
+                    if not self.in_output(path):
+                        yield path
+
+
+class InotifyWatcher:
+    """基于 inotify 的监视器。递归时为每个子目录单独添加监视，新建的子目录会被自动加入"""
+
+    def __init__(self, file_filter):
+        self.filter = file_filter
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 失败: {os.strerror(err)}")
+        self.dirs = {}  # watch descriptor -> 目录
+        try:
+            for root in self.filter.roots:
+                self._add_tree(root, report=False)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _add_watch(self, folder):
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "inotify 监视数量达到上限（可调高 fs.inotify.max_user_watches，或使用 --poll）")
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return False  # 目录在添加监视前已被删除
+            raise OSError(err, f"无法监视 {folder}: {os.strerror(err)}")
+        self.dirs[wd] = folder
+        return True
+
+    def _add_tree(self, folder, report=True):
+        """监视 folder（递归时包括子目录）；report 为 True 时返回其中已有的文件（监视建立前就已写入的）"""
+        found = []
+        stack = [folder]
+        while stack:
+            current = stack.pop()
+            if self.filter.in_output(current) or not self._add_watch(current):
+                continue
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.filter.recursive:
+                                stack.append(entry.path)
+                        elif report:
+                            found.append(entry.path)
+            except OSError:
+                pass
+        return found
+
+    def wait(self, timeout):
+        """
+        等待至多 timeout 秒，返回 (有变化的文件路径列表, 其中写入方已关闭或整体移入的路径集合, 是否需要全量重新扫描)。
+        写入方关闭文件（IN_CLOSE_WRITE）或整体移入（IN_MOVED_TO）的文件多半已经写完，只需短暂确认（见 StabilityTracker）。
+        事件队列溢出时内核会丢弃事件，此时要求调用方重新扫描。
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return [], set(), False
+        paths = []
+        closed = set()
+        rescan = False
+        while True:
+            try:
+                data = os.read(self.fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+                offset += name_len
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+                folder = self.dirs.get(wd)
+                if folder is None or not name:
+                    continue
+                path = os.path.join(folder, name)
+                if mask & IN_ISDIR:
+                    if self.filter.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                        found = self._add_tree(path)
+                        paths.extend(found)
+                        if mask & IN_MOVED_TO:
+                            closed.update(found)
+                else:
+                    paths.append(path)
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        closed.add(path)
+                    else:
+                        closed.discard(path)  # 之后又被重新创建，重新等待写完
+            if len(data) < _READ_SIZE:
+                break
+        return paths, closed, rescan
+
+
+class PollingWatcher:
+    """轮询监视器：每隔 interval 秒扫描一次，返回新出现或大小、修改时间变化了的文件"""
+
+    def __init__(self, file_filter, interval=DEFAULT_POLL_INTERVAL):
+        self.filter = file_filter
+        self.interval = interval
+        self.snapshot = self._stat_all()
+        self.next_poll = time.monotonic() + interval
+
+    def close(self):
+        pass
+
+    def _stat_all(self):
+        snapshot = {}
+        for path in self.filter.scan():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        remaining = self.next_poll - time.monotonic()
+        if timeout is not None and timeout < remaining:
+            time.sleep(max(0.0, timeout))
+            return [], set(), False
+        time.sleep(max(0.0, remaining))
+        self.next_poll = time.monotonic() + self.interval
+        snapshot = self._stat_all()
+        changed = [path for path, state in snapshot.items() if self.snapshot.get(path) != state]
+        self.snapshot = snapshot
+        return changed, set(), False
+
+
+class StabilityTracker:
+    """
+    记录尚未写完的文件。文件在 settle 秒内大小与修改时间都没有变化、且修改时间距今至少 settle 秒时视为写完；
+    修改时间较早的文件（如停机期间到达的）第一次检查即可就绪。写入方已关闭或整体移入的文件（inotify 的关闭写入、
+    移入事件）只需 CLOSE_CONFIRM_SECONDS 后确认一次没有变化；关闭后又被追加写入的文件会被发现并重新等满 settle。
+    """
+
+    def __init__(self, settle=DEFAULT_SETTLE_SECONDS):
+        self.settle = settle
+        self.pending = {}  # path -> ((size, mtime_ns), 到期时间, 首次发现时间)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def note(self, path, closed=False):
+        """文件有变化（新建、写入完成、移入）；重新开始计时。closed 为 True 表示写入方已关闭或文件整体移入"""
+        now = time.monotonic()
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        first_seen = self.pending[path][2] if path in self.pending else now
+        age = max(0.0, time.time() - st.st_mtime_ns / 1e9)
+        delay = max(0.0, self.settle - age)
+        if closed:
+            delay = min(delay, CLOSE_CONFIRM_SECONDS)
+        due = now + delay
+        self.pending[path] = ((st.st_size, st.st_mtime_ns), due, first_seen)
+
+    def next_due(self):
+        """距下一个待检查文件到期还有多少秒；没有待检查文件时返回 None"""
+        if not self.pending:
+            return None
+        return max(0.0, min(due for _, due, _ in self.pending.values()) - time.monotonic())
+
+    def pop_ready(self):
+        """检查已到期的文件，返回 [(路径, 首次发现时间)]；仍在变化的文件重新计时"""
+        now = time.monotonic()
+        ready = []
+        for path, (state, due, first_seen) in list(self.pending.items()):
+            if due > now:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]  # 已被删除或移走
+                continue
+            if (st.st_size, st.st_mtime_ns) == state:
+                del self.pending[path]
+                ready.append((path, first_seen))
+            else:
+                self.pending[path] = ((st.st_size, st.st_mtime_ns), now + self.settle, first_seen)
+        return ready
+
+
+def make_watcher(file_filter, poll=False, poll_interval=DEFAULT_POLL_INTERVAL, log=None):
+    """优先使用 inotify；不可用或 poll 为 True 时使用轮询"""
+    if not poll and inotify_available():
+        try:
+            return InotifyWatcher(file_filter)
+        except OSError as e:
+            if log is not None:
+                log(f"{e}，改用轮询")
+    return PollingWatcher(file_filter, poll_interval)
+
+
+def run_watch(roots, settings, output_folder, workers=None, recursive=False, include=None, exclude=None,
+              settle=DEFAULT_SETTLE_SECONDS, poll=False, poll_interval=DEFAULT_POLL_INTERVAL, max_memory_mb=None,
+              on_result=None, log=None, stop_event=None):
+    """
+    监视 roots 直到 stop_event 被置位，返回 (成功数, 失败数)。
+    on_result(result) 在每张图片完成后调用，result 额外带有 latency（从发现文件到输出完成的秒数）。
+    停止时不再开始新的图片，等待在途图片完成并保存清单。
+    """
+    log = log or (lambda msg: None)
+    workers = workers or default_worker_count()
+    os.makedirs(output_folder, exist_ok=True)
+    remove_stale_temp_files(output_folder)
+    file_filter = FileFilter(roots, output_folder, recursive, include, exclude)
+    manifest = ExportManifest(output_folder)
+    tracker = StabilityTracker(settle)
+    ready = deque()  # [(路径, 首次发现时间)]
+    in_flight = {}  # future -> (任务, 首次发现时间)
+    success_count = 0
+    error_count = 0
+    last_save = time.monotonic()
+    dirty = False
+
+    # 先建立监视再扫描现有文件，两者之间到达的文件不会被漏掉（重复的由清单过滤）
+    watcher = make_watcher(file_filter, poll, poll_interval, log)
+    log(f"开始监视 {', '.join(file_filter.roots)}（{'inotify' if isinstance(watcher, InotifyWatcher) else '轮询'}），"
+        f"输出到 {output_folder}")
+    for path in file_filter.scan():
+        tracker.note(path)
+
+    executor = make_executor(workers, max_memory_mb, ignore_sigint=True)
+
+    def submit():
+        nonlocal executor
+        while ready and len(in_flight) < workers * 2:
+            path, first_seen = ready.popleft()
+            job = make_job(path, settings, output_folder, file_filter.subfolder(path))
+            pending, _ = manifest.split_unchanged([job])
+            if not pending:
+                continue  # 已处理过且未变化
+            # 输出文件已属于另一张源图（如同名的 .jpg 与 .png），不互相覆盖
+            output_path = output_path_for(path, settings, job["output_folder"])
+            other = manifest.claimed_by_other(job) or next(
+                (j["image_path"] for j, _ in in_flight.values()
+                 if j["image_path"] != path and output_path_for(j["image_path"], settings, j["output_folder"]) == output_path),
+                None)
+            if other is not None:
+                report(failed_result(path, output_conflict_error(output_path, other), rendered=False), first_seen)
+                continue
+            try:
+                future = executor.submit(export_one, job, max_memory_mb)
+            except BrokenProcessPool:
+                # 子进程被系统杀掉（如内存耗尽）后进程池不可再用，换一个新的继续服务
+                log("进程池异常退出，重新创建")
+                executor.shutdown(wait=False)
+                executor = make_executor(workers, max_memory_mb, ignore_sigint=True)
+                future = executor.submit(export_one, job, max_memory_mb)
+            in_flight[future] = (job, first_seen)
+
+    def report(result, first_seen, job=None):
+        nonlocal success_count, error_count, dirty
+        profile = result.pop("profile", None)
+        if profile:
+            profiling.merge(profile)
+        result["latency"] = time.monotonic() - first_seen
+        if result["ok"]:
+            success_count += 1
+            if "source_stat" in job:
+                manifest.record(job, result["output_path"])
+                dirty = True
+        else:
+            error_count += 1
+        if on_result is not None:
+            on_result(result)
+
+    def handle(future):
+        job, first_seen = in_flight.pop(future)
+        try:
+            result = future.result()
+        except BrokenProcessPool as e:
+            result = failed_result(job["image_path"], f"处理进程异常退出: {e}")
+        report(result, first_seen, job)
+
+    try:
+        while not (stop_event is not None and stop_event.is_set()):
+            # 有在途任务时短间隔返回以便及时收集结果，否则等到下一个文件到期
+            timeout = tracker.next_due()
+            if in_flight:
+                done, _ = wait(list(in_flight), timeout=0)
+                for future in done:
+                    handle(future)
+                timeout = 0.05 if timeout is None else min(timeout, 0.05)
+            elif timeout is None:
+                timeout = IDLE_TIMEOUT
+                if dirty and time.monotonic() - last_save >= MANIFEST_SAVE_INTERVAL:
+                    manifest.save()
+                    last_save = time.monotonic()
+                    dirty = False
+
+            paths, closed, rescan = watcher.wait(timeout)
+            if rescan:
+                log("事件队列溢出，重新扫描输入文件夹")
+                paths = list(file_filter.scan())
+            for path in paths:
+                if file_filter.accept(path):
+                    tracker.note(path, path in closed)
+            ready.extend(tracker.pop_ready())
+            submit()
+
+        # 停止：不再开始新的图片，等待在途图片完成
+        while in_flight:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                handle(future)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        watcher.close()
+        manifest.save()
+    return success_count, error_count
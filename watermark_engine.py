@@ -0,0 +1,722 @@
+# watermark_engine.py
+# ----------------------
+# 与 GUI 无关的水印渲染引擎
+# GUI、批量导出进程池和命令行都通过这里渲染，保证输出一致。
+# 本模块只依赖 Pillow，可以在子进程或无显示的服务器上运行。
+# ----------------------
+import os
+import uuid
+import struct
+from collections import OrderedDict
+from functools import lru_cache
+from dataclasses import dataclass, asdict, replace
+from typing import Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont, features
+
+import profiling
+import numpy_compositor
+
+# Pillow 的解压炸弹检查按固定像素数拒绝大图（约 1.8 亿像素以上直接报错）。
+# 该检查对缩略图、水印图片等保持不变；只有 open_image 在内存上限生效时跳过它，改按内存估算检查（见 _open_unchecked）
+
+
+class ImageTooLargeError(Exception):
+    pass
+
+POSITIONS = ["左上角", "上中", "右上角", "左中", "居中", "右中", "左下角", "下中", "右下角", "手动", "平铺"]
+# 平铺模式：旋转后的水印按网格重复铺满整幅图像
+TILED_POSITION = "平铺"
+# 水印类型：文字，或带透明通道的图片（如 PNG 格式的 logo）
+WATERMARK_TYPES = ["文字", "图片"]
+IMAGE_WATERMARK = "图片"
+OUTPUT_FORMATS = ["JPEG", "PNG", "WEBP", "AVIF"]
+# 编码预设：标准 = 按模板中的各项参数；快速 = 牺牲体积换编码速度；最小体积 = 反之
+ENCODE_PRESETS = ["标准", "快速", "最小体积"]
+JPEG_SUBSAMPLINGS = ["4:2:0", "4:2:2", "4:4:4"]
+SUPPORTED_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif']
+MARGIN = 10
+# 超过该像素数的图片按大图处理：不透明的源图无论输出格式都直接在 RGB 上贴入水印，不做整幅 RGBA 转换
+LARGE_IMAGE_PIXELS = 40_000_000
+# 每个进程处理单张图片时允许占用的内存（MB），0 表示不限制
+DEFAULT_MAX_MEMORY_MB = 4096
+# Pillow 内部每像素占用的字节数（RGB 也按 4 字节存放）
+_BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2, "LA": 4, "La": 4, "PA": 4}
+TILE_CACHE_SIZE = 8
+FONT_CACHE_SIZE = 32
+# 缩放后的水印图片缓存条数（每个目标尺寸一条）；原图解码结果另外缓存，见 _decode_logo
+LOGO_CACHE_SIZE = 16
+# 包围盒内的混合实现：pillow = Pillow 内置的 C 实现（默认）；numpy = numpy_compositor（需安装 NumPy）
+# 两者输出逐位一致，可通过环境变量或 set_compositor() 切换，子进程继承环境变量
+COMPOSITORS = ["pillow", "numpy"]
+COMPOSITOR_ENV = "PHOTOWATERMARK_COMPOSITOR"
+_compositor = os.environ.get(COMPOSITOR_ENV, "pillow")
+
+
+def set_compositor(name):
+    """选择混合实现；选择 numpy 但未安装 NumPy 时抛出 ValueError"""
+    global _compositor
+    if name not in COMPOSITORS:
+        raise ValueError(f"未知的合成实现: {name}")
+    if name == "numpy" and not numpy_compositor.available():
+        raise ValueError("未安装 NumPy，无法使用 numpy 合成实现")
+    os.environ[COMPOSITOR_ENV] = name
+    _compositor = name
+
+
+def _use_numpy():
+    return _compositor == "numpy" and numpy_compositor.available()
+
+
+# ----------------------
+# 帮助寻找系统字体路径（常见位置）
+# 结果在进程内缓存，只探测一次文件系统
+# ----------------------
+@lru_cache(maxsize=None)
+def find_system_font_path():
+    candidates = [
+        # Windows 常见
+        r"C:\Windows\Fonts\arial.ttf",
+        r"C:\Windows\Fonts\ARIAL.TTF",
+        r"C:\Windows\Fonts\msyh.ttf",
+        # Linux 常见
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "/usr/share/fonts/truetype/freefont/FreeSans.ttf",
+        # macOS 常见
+        "/Library/Fonts/Arial.ttf",
+        "/System/Library/Fonts/SFNSText.ttf",
+        "/System/Library/Fonts/Helvetica.ttc",
+    ]
+    for p in candidates:
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def available_output_formats():
+    """当前 Pillow 能编码的输出格式（WEBP/AVIF 取决于编译选项或插件）"""
+    Image.init()
+    formats = ["JPEG", "PNG"]
+    try:
+        if features.check("webp"):
+            formats.append("WEBP")
+    except Exception:
+        pass
+    if "AVIF" in Image.SAVE:
+        formats.append("AVIF")
+    return formats
+
+
+# ----------------------
+# 水印设置（不可变，可 pickle）
+# ----------------------
+@dataclass(frozen=True)
+class WatermarkSettings:
+    text: str = "Watermark"
+    font_size: int = 32  # 原图像上的像素大小
+    opacity: int = 50  # 0~100
+    color: Tuple[int, int, int] = (0, 0, 0)
+    position: str = "右下角"
+    custom_pos: Optional[Tuple[float, float]] = None  # 原图像像素坐标，中心点锚
+    output_format: str = "JPEG"
+    naming_rule: int = 0  # 0 保留原文件名 / 1 添加前缀 / 2 添加后缀
+    name_modifier: str = "wm_"
+    font_path: Optional[str] = None
+    # 编码参数（默认值与 Pillow 默认一致）
+    quality: int = 75  # JPEG / WEBP / AVIF
+    jpeg_subsampling: str = "4:2:0"
+    progressive: bool = False
+    optimize: bool = False
+    png_compress_level: int = 6
+    encode_preset: str = "标准"
+    # 图片水印（watermark_type 为 "图片" 时生效）
+    watermark_type: str = "文字"
+    logo_path: Optional[str] = None
+    logo_scale: int = 20  # 水印图片宽度占目标图像宽度的百分比
+    # 平铺模式参数（position 为 "平铺" 时生效）
+    tile_spacing: int = 120  # 相邻两个水印之间的间距（原图像素）
+    tile_angle: int = 30  # 文字旋转角度（度，逆时针）
+    tile_stagger: bool = True  # 隔行错开半个单元
+
+    @classmethod
+    def from_template(cls, tpl, font_path=None):
+        """由模板 dict（save_current_as_template 写出的 JSON）构造设置，缺失项使用默认值"""
+        defaults = cls()
+        col = tpl.get("color", defaults.color)
+        if not (isinstance(col, (list, tuple)) and len(col) >= 3):
+            col = defaults.color
+        cp = tpl.get("custom_pos", None)
+        if isinstance(cp, (list, tuple)) and len(cp) >= 2:
+            cp = (float(cp[0]), float(cp[1]))
+        else:
+            cp = None
+        nr = tpl.get("naming_rule", defaults.naming_rule)
+        subsampling = tpl.get("jpeg_subsampling", defaults.jpeg_subsampling)
+        preset = tpl.get("encode_preset", defaults.encode_preset)
+        wm_type = tpl.get("watermark_type", defaults.watermark_type)
+        return cls(
+            text=tpl.get("text", defaults.text),
+            font_size=int(tpl.get("font_size", defaults.font_size)),
+            opacity=int(tpl.get("opacity", defaults.opacity)),
+            color=(int(col[0]), int(col[1]), int(col[2])),
+            position=tpl.get("position", defaults.position),
+            custom_pos=cp,
+            output_format=tpl.get("output_format", None) or defaults.output_format,
+            naming_rule=nr if isinstance(nr, int) else defaults.naming_rule,
+            name_modifier=tpl.get("name_modifier", defaults.name_modifier),
+            font_path=font_path if font_path is not None else tpl.get("font_path", None),
+            quality=max(1, min(100, int(tpl.get("quality", defaults.quality)))),
+            jpeg_subsampling=subsampling if subsampling in JPEG_SUBSAMPLINGS else defaults.jpeg_subsampling,
+            progressive=bool(tpl.get("progressive", defaults.progressive)),
+            optimize=bool(tpl.get("optimize", defaults.optimize)),
+            png_compress_level=max(0, min(9, int(tpl.get("png_compress_level", defaults.png_compress_level)))),
+            encode_preset=preset if preset in ENCODE_PRESETS else defaults.encode_preset,
+            watermark_type=wm_type if wm_type in WATERMARK_TYPES else defaults.watermark_type,
+            logo_path=tpl.get("logo_path", None) or None,
+            logo_scale=max(1, min(100, int(tpl.get("logo_scale", defaults.logo_scale)))),
+            tile_spacing=max(0, int(tpl.get("tile_spacing", defaults.tile_spacing))),
+            tile_angle=int(tpl.get("tile_angle", defaults.tile_angle)) % 360,
+            tile_stagger=bool(tpl.get("tile_stagger", defaults.tile_stagger)),
+        )
+
+    def to_template(self):
+        """转为可 JSON 序列化的模板 dict"""
+        tpl = asdict(self)
+        tpl["color"] = list(self.color)
+        tpl["custom_pos"] = list(self.custom_pos) if self.custom_pos is not None else None
+        return tpl
+
+    def with_custom_pos(self, custom_pos):
+        return replace(self, custom_pos=tuple(custom_pos) if custom_pos is not None else None)
+
+
+# ----------------------
+# 渲染
+# ----------------------
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_path, font_size):
+    """按 (字体路径, 字号) 缓存字体对象，整个批次中每个进程只解析一次 TTF"""
+    with profiling.stage("truetype"):
+        # 优先使用找到的系统字体路径
+        if font_path:
+            try:
+                return ImageFont.truetype(font_path, font_size)
+            except Exception:
+                pass
+        try:
+            return ImageFont.truetype("arial.ttf", font_size)
+        except Exception:
+            return ImageFont.load_default()
+
+
+def font_cache_info():
+    """字体缓存的命中/未命中计数。文字水印块缓存命中时不会调用 load_font，这里只反映水印块缓存未命中的情况"""
+    info = load_font.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+
+
+def cache_info():
+    """进程内各缓存的命中/未命中计数（命令行 --stats 输出），用于确认缓存生效"""
+    return {"text_tile": tile_cache_info(), "font": font_cache_info()}
+
+
+def measure_text(draw, text, font):
+    # 文本尺寸（兼容旧/新 pillow）
+    try:
+        return draw.textsize(text, font=font)
+    except AttributeError:
+        bbox = draw.textbbox((0, 0), text, font=font)
+        return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+
+def compute_position(image_size, text_size, position, custom_pos=None, margin=MARGIN):
+    """按九宫格位置（或手动中心点）计算文字左上角坐标"""
+    width, height = image_size
+    text_width, text_height = text_size
+
+    if position == "手动" and custom_pos is not None:
+        cx_img, cy_img = custom_pos
+        return int(cx_img - text_width / 2), int(cy_img - text_height / 2)
+
+    if position == "左上角":
+        return margin, margin
+    elif position == "上中":
+        return (width - text_width) // 2, margin
+    elif position == "右上角":
+        return width - text_width - margin, margin
+    elif position == "左中":
+        return margin, (height - text_height) // 2
+    elif position == "居中":
+        return (width - text_width) // 2, (height - text_height) // 2
+    elif position == "右中":
+        return width - text_width - margin, (height - text_height) // 2
+    elif position == "左下角":
+        return margin, height - text_height - margin
+    elif position == "下中":
+        return (width - text_width) // 2, height - text_height - margin
+    else:
+        # 右下角，也是未知位置的默认值
+        return width - text_width - margin, height - text_height - margin
+
+
+# 文字水印块缓存：key 为影响文字外观的设置，value 为 (tile, 墨迹偏移, 排版尺寸)
+# 同一批次设置不变，每个进程只需绘制一次；设置变化后旧条目按 LRU 淘汰
+_tile_cache = OrderedDict()
+_tile_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _tile_key(settings):
+    return (settings.text or "Watermark", settings.font_path, settings.font_size,
+            settings.color, settings.opacity)
+
+
+def clear_tile_cache():
+    _tile_cache.clear()
+    _tile_cache_stats.update(hits=0, misses=0)
+
+
+def tile_cache_info():
+    """文字水印块缓存的命中/未命中计数"""
+    return dict(_tile_cache_stats, size=len(_tile_cache), maxsize=TILE_CACHE_SIZE)
+
+
+def get_text_tile(settings):
+    """
+    返回只包含文字墨迹范围的小 RGBA 块。
+    offset 是墨迹相对于绘制原点的偏移，text_size 是用于九宫格定位的文字尺寸，
+    与直接在整幅透明图层上 draw.text 的结果逐像素一致。
+    """
+    key = _tile_key(settings)
+    cached = _tile_cache.get(key)
+    if cached is not None:
+        _tile_cache.move_to_end(key)
+        _tile_cache_stats["hits"] += 1
+        return cached
+
+    _tile_cache_stats["misses"] += 1
+    text = key[0]
+    pil_font = load_font(settings.font_path, settings.font_size)
+    with profiling.stage("text_tile"):
+        draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+        text_size = measure_text(draw, text, pil_font)
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=pil_font)
+
+        r, g, b = settings.color
+        alpha = int(255 * settings.opacity / 100)
+        tile = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (255, 255, 255, 0))
+        ImageDraw.Draw(tile).text((-left, -top), text, font=pil_font, fill=(r, g, b, alpha))
+
+    cached = (tile, (left, top), text_size)
+    _tile_cache[key] = cached
+    while len(_tile_cache) > TILE_CACHE_SIZE:
+        _tile_cache.popitem(last=False)
+    return cached
+
+
+@lru_cache(maxsize=4)
+def _decode_logo(logo_path, mtime_ns, size):
+    """
+    解码水印图片并转为预乘 alpha 的 RGBa，按 (路径, 修改时间, 大小) 缓存：同一文件每个进程只解码一次，
+    之后每次缩放都直接在预乘数据上进行（透明边缘不会混入黑边，也不必每次重新预乘整幅原图）。
+    """
+    with profiling.stage("logo_decode"):
+        with Image.open(logo_path) as logo:
+            return logo.convert('RGBA').convert('RGBa')
+
+
+# 缩放后的水印图片缓存：key 为 (文件, 目标尺寸, 不透明度)，value 与 get_text_tile 的返回值格式相同
+_logo_cache = OrderedDict()
+
+
+def clear_logo_cache():
+    _logo_cache.clear()
+    _decode_logo.cache_clear()
+
+
+def _opacity_lut(opacity):
+    return [v * opacity // 100 for v in range(256)]
+
+
+def get_logo_tile(settings, image_size):
+    """
+    返回按目标图像宽度缩放好的水印图片块 (tile, 偏移, 尺寸)，tile 为 RGBA 且已乘上不透明度。
+    宽度为图像宽度的 logo_scale%，保持宽高比。批量处理不同分辨率的图片时，每个尺寸只缩放一次。
+    """
+    if not settings.logo_path:
+        raise ValueError("未选择水印图片")
+    st = os.stat(settings.logo_path)
+    master = _decode_logo(settings.logo_path, st.st_mtime_ns, st.st_size)
+    width = max(1, round(image_size[0] * settings.logo_scale / 100))
+    height = max(1, round(master.height * width / master.width))
+    key = (settings.logo_path, st.st_mtime_ns, st.st_size, width, height, settings.opacity)
+    cached = _logo_cache.get(key)
+    if cached is not None:
+        _logo_cache.move_to_end(key)
+        return cached
+
+    with profiling.stage("logo_resize"):
+        resized = master.resize((width, height), Image.LANCZOS) if (width, height) != master.size else master
+        tile = resized.convert('RGBA')
+        if settings.opacity < 100:
+            tile.putalpha(tile.getchannel('A').point(_opacity_lut(settings.opacity)))
+
+    cached = (tile, (0, 0), (width, height))
+    _logo_cache[key] = cached
+    while len(_logo_cache) > LOGO_CACHE_SIZE:
+        _logo_cache.popitem(last=False)
+    return cached
+
+
+def get_watermark_tile(settings, image_size):
+    """按水印类型返回文字块或缩放后的图片块"""
+    if settings.watermark_type == IMAGE_WATERMARK:
+        return get_logo_tile(settings, image_size)
+    return get_text_tile(settings)
+
+
+def _clip_tile(image_size, tile_size, dest):
+    """把 tile 放到 dest 处并裁剪到图像范围内，返回 (dest, source box)，完全在图外时返回 None"""
+    width, height = image_size
+    tw, th = tile_size
+    x, y = dest
+    left, top = max(0, -x), max(0, -y)
+    right, bottom = min(tw, width - x), min(th, height - y)
+    if right <= left or bottom <= top:
+        return None
+    return (x + left, y + top), (left, top, right, bottom)
+
+
+# ----------------------
+# 平铺水印：旋转后的水印只绘制一次成为图案单元，再横向复制成条带，按图像宽度缓存
+# 两级缓存都以所用的水印块 / 单元对象为键（同时保存对象本身，id 不会被复用）
+# ----------------------
+_pattern_cell_cache = OrderedDict()
+_pattern_strip_cache = OrderedDict()
+
+
+def clear_pattern_cache():
+    _pattern_cell_cache.clear()
+    _pattern_strip_cache.clear()
+
+
+def _cache_put(cache, key, value):
+    cache[key] = value
+    while len(cache) > TILE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def get_pattern_cell(settings, image_size):
+    """
+    返回平铺图案的最小重复单元（RGBA）。
+    单元为旋转后的水印加上间距；错行时单元高两行，第二行的水印右移半个单元（跨边界的部分绕回左侧），
+    因此单元本身可以直接无缝平铺。GUI 预览使用同一个单元。
+    image_size 只用于确定图片水印的缩放尺寸。
+    """
+    tile, _, _ = get_watermark_tile(settings, image_size)
+    key = (id(tile), settings.tile_spacing, settings.tile_angle, settings.tile_stagger)
+    cached = _pattern_cell_cache.get(key)
+    if cached is not None and cached[0] is tile:
+        _pattern_cell_cache.move_to_end(key)
+        return cached[1]
+
+    with profiling.stage("pattern_cell"):
+        # 在预乘 alpha 下旋转，透明边缘不会混入背景色
+        glyphs = tile.convert('RGBa').rotate(settings.tile_angle, resample=Image.BICUBIC, expand=True)
+        spacing = settings.tile_spacing
+        cw, ch = glyphs.width + spacing, glyphs.height + spacing
+        half = spacing // 2
+        if settings.tile_stagger:
+            cell = Image.new('RGBa', (cw, ch * 2), 0)
+            cell.paste(glyphs, (half, half))
+            shifted = half + cw // 2
+            cell.paste(glyphs, (shifted, ch + half))
+            cell.paste(glyphs, (shifted - cw, ch + half))
+        else:
+            cell = Image.new('RGBa', (cw, ch), 0)
+            cell.paste(glyphs, (half, half))
+        cell = cell.convert('RGBA')
+
+    _cache_put(_pattern_cell_cache, key, (tile, cell))
+    return cell
+
+
+def _tile_row(cell, width):
+    """把单元横向铺满 width：把已填好的部分成倍复制，只需 O(log n) 次整块拷贝"""
+    cw, ch = cell.size
+    row = Image.new(cell.mode, (width, ch), 0)
+    row.paste(cell, (0, 0))
+    filled = cw
+    while filled < width:
+        row.paste(row.crop((0, 0, filled, ch)), (filled, 0))
+        filled *= 2
+    return row
+
+
+def get_pattern_strip(settings, image_size):
+    """
+    返回宽为图像宽度、高为一个单元的 RGBA 平铺条带，按 (图案单元, 宽度) 缓存。
+    整幅图案在纵向上以单元高度为周期，条带自上而下逐段贴入即可，不必为每个图像尺寸分配整幅蒙版。
+    """
+    cell = get_pattern_cell(settings, image_size)
+    width = image_size[0]
+    key = (id(cell), width)
+    cached = _pattern_strip_cache.get(key)
+    if cached is not None and cached[0] is cell:
+        _pattern_strip_cache.move_to_end(key)
+        return cached[1]
+    with profiling.stage("pattern_strip"):
+        row = _tile_row(cell, width)
+    _cache_put(_pattern_strip_cache, key, (cell, row))
+    return row
+
+
+def _composite_pattern(img, settings):
+    row = get_pattern_strip(settings, img.size)
+    with profiling.stage("composite"):
+        for y in range(0, img.height, row.height):
+            if img.mode == 'RGB':
+                img.paste(row, (0, y), mask=row)  # 超出图像底部的部分由 paste 裁掉
+            else:
+                img.alpha_composite(row, dest=(0, y), source=(0, 0, row.width, min(row.height, img.height - y)))
+
+
+def is_jpeg_format(output_format):
+    return output_format.lower() in ('jpeg', 'jpg')
+
+
+def is_opaque(image):
+    """图像本身没有透明信息（无 alpha 通道、调色板无透明色）"""
+    if image.mode in ('RGB', 'L', 'CMYK', 'YCbCr'):
+        return True
+    return image.mode == 'P' and 'transparency' not in image.info
+
+
+def is_large_image(image):
+    return image.width * image.height >= LARGE_IMAGE_PIXELS
+
+
+def _uses_rgb_path(image, settings):
+    return is_opaque(image) and (is_jpeg_format(settings.output_format) or is_large_image(image))
+
+
+def estimate_memory(image, settings):
+    """
+    按图像头信息估算处理一张图的峰值内存（字节）。
+    渲染时原图与整幅转换结果同时存在；转换后原图即被释放（见 render_file），
+    保存 JPEG 时若结果不是 RGB 还要再转换一次。
+    """
+    pixels = image.width * image.height
+    decoded = pixels * _BYTES_PER_PIXEL.get(image.mode, 4)
+    target_mode = 'RGB' if _uses_rgb_path(image, settings) else 'RGBA'
+    rendered = pixels * 4
+    peak = decoded + rendered if image.mode != target_mode else decoded
+    if is_jpeg_format(settings.output_format) and target_mode != 'RGB':
+        peak = max(peak, rendered + pixels * 4)
+    return peak
+
+
+def render(image, settings, in_place=False):
+    """
+    在 image 上绘制水印并返回结果图像。
+    - 不透明的源图且输出 JPEG（或大图，见 LARGE_IMAGE_PIXELS）：直接在 RGB 图上用 tile 的 alpha 作蒙版贴入，
+      不做整幅 RGBA 转换，返回 RGB 图像；
+    - 其他情况：转换为 RGBA 后只在文字包围盒内 alpha 合成，返回 RGBA 图像。
+    平铺模式（position 为 "平铺"）用缓存的平铺条带逐段混合，不逐个绘制文字。
+    in_place=True 时允许直接修改传入的 image（调用方不再使用原图时可省去一次整幅复制）。
+    """
+    with profiling.stage("convert"):
+        if _uses_rgb_path(image, settings):
+            if image.mode != 'RGB':
+                img = image.convert('RGB')
+            else:
+                img = image if in_place else image.copy()
+        elif image.mode != 'RGBA':
+            img = image.convert('RGBA')
+        else:
+            img = image if in_place else image.copy()
+
+    if settings.position == TILED_POSITION:
+        _composite_pattern(img, settings)
+        return img
+
+    tile, (left, top), text_size = get_watermark_tile(settings, img.size)
+    x, y = compute_position(img.size, text_size, settings.position, settings.custom_pos)
+
+    # 只在文字所在的包围盒内混合，不再分配整幅透明图层
+    clipped = _clip_tile(img.size, tile.size, (x + left, y + top))
+    if clipped is not None:
+        dest, source = clipped
+        with profiling.stage("composite"):
+            if _use_numpy():
+                numpy_compositor.composite(img, tile, dest, source)
+            elif img.mode == 'RGB':
+                region = tile.crop(source) if source != (0, 0) + tile.size else tile
+                img.paste(region, dest, mask=region)
+            else:
+                img.alpha_composite(tile, dest=dest, source=source)
+    return img
+
+
+def output_file_name(image_path, settings):
+    """按命名规则与输出格式生成输出文件名"""
+    base_name, _ = os.path.splitext(os.path.basename(image_path))
+    if settings.naming_rule == 1:
+        new_base_name = f"{settings.name_modifier}{base_name}"
+    elif settings.naming_rule == 2:
+        new_base_name = f"{base_name}{settings.name_modifier}"
+    else:
+        new_base_name = base_name
+    return f"{new_base_name}.{settings.output_format.lower()}"
+
+
+def _open_unchecked(image_path):
+    """
+    不做 Pillow 的像素数检查打开图片（只读文件头），只在正常打开已被拒绝时使用。
+    像 Image.open 一样按文件头依次尝试格式插件，只是不调用检查；不修改进程全局的 MAX_IMAGE_PIXELS，
+    其他线程（缩略图、流水线读取）中同时打开的图片仍照常检查。
+    """
+    Image.init()
+    with open(image_path, "rb") as f:
+        prefix = f.read(16)
+    for fmt in Image.ID:
+        factory, accept = Image.OPEN[fmt]
+        try:
+            accepted = not accept or accept(prefix)
+            if accepted and not isinstance(accepted, str):
+                # 传入路径时由插件自己打开文件，关闭图片时一并关闭，识别失败时插件也会关闭
+                return factory(image_path, image_path)
+        except (SyntaxError, IndexError, TypeError, struct.error):
+            continue
+    raise Image.UnidentifiedImageError(f"cannot identify image file {image_path!r}")
+
+
+def open_image(image_path, settings=None, max_memory_mb=None):
+    """
+    打开并完整解码图片（导出流水线的读取阶段）。多页 TIFF/GIF 只解码第一帧。
+    给出 settings 时先按图像头估算处理所需内存，超过 max_memory_mb（None 为默认值，0 为不限制）
+    则在解码前抛出 ImageTooLargeError，避免把整个进程拖到内存耗尽。
+    超过 Pillow 像素数上限的大图只有在内存上限生效、且估算通过时才会解码；不限制内存时仍由 Pillow 拒绝。
+    """
+    if max_memory_mb is None:
+        max_memory_mb = DEFAULT_MAX_MEMORY_MB
+    check_memory = settings is not None and max_memory_mb > 0
+    with profiling.stage("open"):
+        # 只读取文件头，像素数据尚未解码
+        try:
+            img = Image.open(image_path)
+        except Image.DecompressionBombError:
+            if not check_memory:
+                raise
+            img = _open_unchecked(image_path)
+    try:
+        if check_memory:
+            needed = estimate_memory(img, settings)
+            if needed > max_memory_mb * 1024 * 1024:
+                raise ImageTooLargeError(
+                    f"图像过大（{img.width}x{img.height} {img.mode}，处理约需 {needed // (1024 * 1024)} MB，"
+                    f"超过内存上限 {max_memory_mb} MB）")
+        with profiling.stage("decode"):
+            img.load()
+    except Exception:
+        img.close()
+        raise
+    return img
+
+
+def encoder_options(settings):
+    """根据模板中的编码参数与预设，返回 (Pillow 格式名, save() 关键字参数)"""
+    fmt = settings.output_format.upper()
+    if fmt == "JPG":
+        fmt = "JPEG"
+    preset = settings.encode_preset
+    if fmt == "JPEG":
+        opts = {"quality": settings.quality, "subsampling": settings.jpeg_subsampling,
+                "progressive": settings.progressive, "optimize": settings.optimize}
+        if preset == "快速":
+            # 4:2:0 的色度数据只有 4:4:4 的一半，编码更快；模板选了 4:4:4 时也以速度优先
+            opts.update(subsampling="4:2:0", progressive=False, optimize=False)
+        elif preset == "最小体积":
+            opts.update(progressive=True, optimize=True)
+    elif fmt == "PNG":
+        # “优化”属于 JPEG 选项；PNG 的 optimize 会强制压缩级别 9，不能覆盖用户设置的压缩级别
+        opts = {"compress_level": settings.png_compress_level}
+        if preset == "快速":
+            opts.update(compress_level=1)
+        elif preset == "最小体积":
+            opts.update(compress_level=9, optimize=True)
+    elif fmt == "WEBP":
+        opts = {"quality": settings.quality,
+                "method": {"快速": 0, "最小体积": 6}.get(preset, 4)}
+    elif fmt == "AVIF":
+        opts = {"quality": settings.quality,
+                "speed": {"快速": 10, "最小体积": 4}.get(preset, 6)}
+    else:
+        opts = {}
+    return fmt, opts
+
+
+def _fsync_dir(folder):
+    """把目录项（重命名结果）落盘；Windows 不能打开目录，跳过即可"""
+    try:
+        fd = os.open(folder or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def save_image(image, output_path, settings):
+    """
+    按输出格式编码并写入文件（导出流水线的写出阶段）。
+    先写入同目录下的临时文件、fsync 后再原子替换，崩溃或断电都不会留下被截断的输出文件
+    （完成日志会把该图片记为已完成，resume 时不会再检查输出内容）。
+    """
+    if is_jpeg_format(settings.output_format) and image.mode != 'RGB':
+        with profiling.stage("convert"):
+            image = image.convert('RGB')
+    fmt, opts = encoder_options(settings)
+    folder = os.path.dirname(output_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)  # 镜像源目录结构时子目录可能还不存在
+    # 临时文件用 "x" 模式新建，权限与直接写出时一致（遵循 umask）
+    tmp_path = os.path.join(folder, f".{uuid.uuid4().hex}.tmp")
+    try:
+        with profiling.stage("save"):
+            with open(tmp_path, "xb") as f:
+                image.save(f, format=fmt, **opts)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, output_path)
+            _fsync_dir(folder)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def output_path_for(image_path, settings, output_folder):
+    return os.path.join(output_folder, output_file_name(image_path, settings))
+
+
+def render_file(image_path, settings, output_folder, max_memory_mb=None):
+    """读取 image_path、加水印并保存到 output_folder，返回输出路径"""
+    img = open_image(image_path, settings, max_memory_mb)
+    watermarked = None
+    try:
+        watermarked = render(img, settings, in_place=True)
+    finally:
+        # 转换出新图像后立即释放解码的原图，编码时只保留一份整幅数据
+        if watermarked is not img:
+            img.close()
+    output_path = output_path_for(image_path, settings, output_folder)
+    try:
+        save_image(watermarked, output_path, settings)
+    finally:
+        watermarked.close()
+    return output_path